@@ -7,7 +7,9 @@ import json
 #from geventwebsocket.handler import WebSocketHandler
 import re
 import numpy as np
-from threading import Thread,Event
+from threading import Thread,Event,Lock
+import queue
+from queue import Queue
 #import multiprocessing
 import torch.multiprocessing as mp
 
@@ -17,6 +19,8 @@ import aiohttp_cors
 from aiortc import RTCPeerConnection, RTCSessionDescription,RTCIceServer,RTCConfiguration
 from aiortc.rtcrtpsender import RTCRtpSender
 from webrtc import HumanPlayer
+from broadcast import BroadcastHub
+from httpflv import FlvStream
 from basereal import BaseReal
 from llm import llm_response
 
@@ -26,6 +30,7 @@ import shutil
 import asyncio
 import torch
 from typing import Dict
+from functools import partial
 from logger import logger
 import gc
 
@@ -33,9 +38,14 @@ import gc
 app = Flask(__name__)
 #sockets = Sockets(app)
 nerfreals:Dict[int, BaseReal] = {} #sessionid:BaseReal
+broadcasts:Dict[int, BroadcastHub] = {} #sessionid:BroadcastHub, sessions watched by many viewers
+flvstreams:Dict[int, FlvStream] = {} #sessionid:FlvStream, --transport flv
 opt = None
 model = None
 avatar = None
+scheduler = None #shared cross-session inference scheduler
+nerfreal_pool = Queue() #pre-built sessions waiting for /offer
+pool_lock = Lock()
         
 
 #####webrtc###############################
@@ -51,23 +61,68 @@ def build_nerfreal(sessionid:int)->BaseReal:
     opt.sessionid=sessionid
     if opt.model == 'wav2lip':
         from lipreal import LipReal
-        nerfreal = LipReal(opt,model,avatar)
+        nerfreal = LipReal(opt,model,avatar,scheduler)
     elif opt.model == 'musetalk':
         from musereal import MuseReal
-        nerfreal = MuseReal(opt,model,avatar)
+        nerfreal = MuseReal(opt,model,avatar,scheduler)
     # elif opt.model == 'ernerf':
     #     from nerfreal import NeRFReal
     #     nerfreal = NeRFReal(opt,model,avatar)
     elif opt.model == 'ultralight':
         from lightreal import LightReal
-        nerfreal = LightReal(opt,model,avatar)
+        nerfreal = LightReal(opt,model,avatar,scheduler)
     return nerfreal
 
+def fill_pool():
+    with pool_lock:
+        while nerfreal_pool.qsize() < opt.session_pool:
+            nerfreal_pool.put(build_nerfreal(0))
+            logger.info('session pool size=%d',nerfreal_pool.qsize())
+
+def recycle_nerfreal(nerfreal:BaseReal):
+    if nerfreal is None or not nerfreal.reset():
+        return
+    with pool_lock:
+        if nerfreal_pool.qsize() < opt.session_pool:
+            nerfreal_pool.put(nerfreal)
+            logger.info('session recycled, pool size=%d',nerfreal_pool.qsize())
+
+async def get_nerfreal(sessionid:int)->BaseReal:
+    loop = asyncio.get_event_loop()
+    try:
+        nerfreal = nerfreal_pool.get_nowait()
+        nerfreal.sessionid = sessionid
+    except queue.Empty:
+        nerfreal = await loop.run_in_executor(None, build_nerfreal,sessionid)
+    if opt.session_pool > 0:
+        loop.run_in_executor(None, fill_pool)
+    return nerfreal
+
+def leave_broadcast(sessionid, viewer) -> bool:
+    '''return True when the last viewer left and the session should be closed'''
+    hub = broadcasts.get(sessionid)
+    if hub is None or viewer not in hub.viewers:
+        return False
+    if hub.unsubscribe(viewer) > 0:
+        return False
+    hub.stop()
+    del broadcasts[sessionid]
+    return True
+
 #@app.route('/offer', methods=['POST'])
 async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
+    attach = params.get('attach')
+    if attach is not None and attach not in broadcasts:
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": "broadcast session not found"}
+            ),
+        )
+
     # if len(nerfreals) >= opt.max_session:
     #     logger.info('reach max session')
     #     return web.Response(
@@ -76,11 +131,19 @@ async def offer(request):
     #             {"code": -1, "msg": "reach max session"}
     #         ),
     #     )
-    sessionid = randN(6) #len(nerfreals)
-    nerfreals[sessionid] = None
-    logger.info('sessionid=%d, session num=%d',sessionid,len(nerfreals))
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
-    nerfreals[sessionid] = nerfreal
+    if attach is not None: #one more viewer of a rendering session
+        sessionid = attach
+        viewer = broadcasts[sessionid].subscribe()
+    else:
+        sessionid = randN(6) #len(nerfreals)
+        nerfreals[sessionid] = None
+        logger.info('sessionid=%d, session num=%d',sessionid,len(nerfreals))
+        nerfreal = await get_nerfreal(sessionid)
+        nerfreals[sessionid] = nerfreal
+        viewer = None
+        if params.get('broadcast'):
+            broadcasts[sessionid] = BroadcastHub(nerfreal)
+            viewer = broadcasts[sessionid].subscribe()
     
     #ice_server = RTCIceServer(urls='stun:stun.l.google.com:19302')
     ice_server = RTCIceServer(urls='stun:stun.miwifi.com:3478')
@@ -90,21 +153,25 @@ async def offer(request):
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
         logger.info("Connection state is %s" % pc.connectionState)
-        if pc.connectionState == "failed":
+        state = pc.connectionState
+        if state == "failed":
             await pc.close()
+        if state in ("failed", "closed"): #a failed session is recycled like a closed one
             pcs.discard(pc)
-            del nerfreals[sessionid]
-        if pc.connectionState == "closed":
-            pcs.discard(pc)
-            del nerfreals[sessionid]
+            if viewer is not None and not leave_broadcast(sessionid, viewer):
+                return
+            nerfreal = nerfreals.pop(sessionid,None)
+            if opt.session_pool > 0:
+                asyncio.get_event_loop().run_in_executor(None, recycle_nerfreal,nerfreal)
             gc.collect()
 
-    player = HumanPlayer(nerfreals[sessionid])
+    player = viewer if viewer is not None else HumanPlayer(nerfreals[sessionid])
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
     capabilities = RTCRtpSender.getCapabilities("video")
     preferences = list(filter(lambda x: x.name == "H264", capabilities.codecs))
-    preferences += list(filter(lambda x: x.name == "VP8", capabilities.codecs))
+    if viewer is None: #broadcast viewers get the shared h264 packets
+        preferences += list(filter(lambda x: x.name == "VP8", capabilities.codecs))
     preferences += list(filter(lambda x: x.name == "rtx", capabilities.codecs))
     transceiver = pc.getTransceivers()[1]
     transceiver.setCodecPreferences(preferences)
@@ -338,12 +405,45 @@ async def is_speaking(request):
             ),
         )
 
+async def media_stats(request):
+    try:
+        params = await request.json()
+
+        sessionid = params.get('sessionid',0)
+
+        # 检查 session 是否存在
+        if sessionid not in nerfreals:
+            logger.error(f'Session not found: sessionid={sessionid}')
+            return web.Response(
+                content_type="application/json",
+                text=json.dumps(
+                    {"code": -1, "msg": "会话不存在，请先建立连接"}
+                ),
+            )
+
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": 0, "data": nerfreals[sessionid].media_stats}
+            ),
+        )
+    except Exception as e:
+        logger.exception('exception:')
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
+
 
 async def on_shutdown(app):
     # close peer connections
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
     pcs.clear()
+    for stream in flvstreams.values():
+        stream.stop()
 
 async def post(url,data):
     try:
@@ -353,6 +453,18 @@ async def post(url,data):
     except aiohttp.ClientError as e:
         logger.info(f'Error: {e}')
 
+async def start_flv(sessionid):
+    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    nerfreals[sessionid] = nerfreal
+    flvstreams[sessionid] = FlvStream(nerfreal)
+
+#GET /live/{sessionid}.flv
+async def flv(request):
+    sessionid = int(request.match_info['sessionid'])
+    if sessionid not in flvstreams:
+        raise web.HTTPNotFound(text=f'flv stream {sessionid} not found')
+    return await flvstreams[sessionid].serve(request)
+
 async def run(push_url,sessionid):
     nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
     nerfreals[sessionid] = nerfreal
@@ -393,8 +505,15 @@ if __name__ == '__main__':
 
     #musetalk opt
     parser.add_argument('--avatar_id', type=str, default='avator_1', help="define which avatar in data/avatars")
+    parser.add_argument('--frame_cache_mb', type=int, default=0, help="decode avatar images lazily with a LRU of this many MB per image list, 0 loads all at startup")
+    parser.add_argument('--face_inputs_mb', type=int, default=1024, help="wav2lip/ultralight face inputs larger than this stay in host memory and are uploaded per batch")
     #parser.add_argument('--bbox_shift', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=16, help="infer batch")
+    parser.add_argument('--latency_budget', type=int, default=0, help="ms of video in flight between asr and viewer per session, 0 uses 3 batches")
+    parser.add_argument('--whisper_stream', action='store_true', help="musetalk: encode only the real audio window instead of a padded 30s segment")
+    parser.add_argument('--mel_stream', action='store_true', help="wav2lip: compute mel frames incrementally instead of per window")
+    parser.add_argument('--hubert_cache', action='store_true', help="ultralight: reuse hubert features of the overlapping window")
+    parser.add_argument('--hubert_cache_drift', type=int, default=0, help="debug: every N steps also encode the full window and log the drift of the hubert cache, 0 off")
 
     parser.add_argument('--customvideo_config', type=str, default='', help="custom action json")
 
@@ -405,15 +524,22 @@ if __name__ == '__main__':
     parser.add_argument('--tts_speed', type=float, default=1.0, help="TTS语速 (0.2~3.0, 默认1.0, 建议1.2~1.5加快)")
     parser.add_argument('--tts_volume', type=float, default=1.0, help="TTS音量 (0.1~3.0, 默认1.0)")
     parser.add_argument('--tts_pitch', type=float, default=1.0, help="TTS音调 (0.1~3.0, 默认1.0)")
+    parser.add_argument('--tts_prefetch', type=int, default=0, help="number of sentences synthesized ahead of the one playing, 0 disables")
+    parser.add_argument('--tts_cache_mb', type=int, default=0, help="in-memory cache of synthesized audio shared by all sessions, 0 disables")
+    parser.add_argument('--tts_cache_dir', type=str, default=None, help="also keep the tts cache on disk in this directory")
+    parser.add_argument('--tts_http_pool', type=int, default=10, help="keep-alive connections per tts server shared by all sessions")
     # parser.add_argument('--CHARACTER', type=str, default='test')
     # parser.add_argument('--EMOTION', type=str, default='default')
 
     parser.add_argument('--model', type=str, default='musetalk') #musetalk wav2lip ultralight
 
-    parser.add_argument('--transport', type=str, default='rtcpush') #webrtc rtcpush virtualcam
+    parser.add_argument('--transport', type=str, default='rtcpush') #webrtc rtcpush virtualcam flv
     parser.add_argument('--push_url', type=str, default='http://localhost:1985/rtc/v1/whip/?app=live&stream=livestream') #rtmp://localhost/live/livestream
 
     parser.add_argument('--max_session', type=int, default=1)  #multi session count
+    parser.add_argument('--session_pool', type=int, default=0, help="number of pre-built sessions kept ready for /offer")
+    parser.add_argument('--shared_infer', action='store_true', help="batch model forwards of all sessions in one scheduler")
+    parser.add_argument('--infer_max_wait', type=float, default=10, help="shared_infer: max ms a batch waits for other sessions")
     parser.add_argument('--listenport', type=int, default=8010, help="web listen port")
 
     opt = parser.parse_args()
@@ -429,29 +555,39 @@ if __name__ == '__main__':
     #     model = load_model(opt)
     #     avatar = load_avatar(opt) 
     if opt.model == 'musetalk':
-        from musereal import MuseReal,load_model,load_avatar,warm_up
+        from musereal import MuseReal,load_model,load_avatar,warm_up,infer_batch
         logger.info(opt)
         model = load_model()
-        avatar = load_avatar(opt.avatar_id) 
+        avatar = load_avatar(opt.avatar_id,opt.frame_cache_mb) 
         warm_up(opt.batch_size,model)      
+        infer_fn = partial(infer_batch,*model[:4]) #vae, unet, pe, timesteps
     elif opt.model == 'wav2lip':
-        from lipreal import LipReal,load_model,load_avatar,warm_up
+        from lipreal import LipReal,load_model,load_avatar,warm_up,infer_batch
         logger.info(opt)
         model = load_model("./models/wav2lip.pth")
-        avatar = load_avatar(opt.avatar_id)
+        avatar = load_avatar(opt.avatar_id,opt.frame_cache_mb,opt.face_inputs_mb)
         warm_up(opt.batch_size,model,256)
+        infer_fn = partial(infer_batch,model)
     elif opt.model == 'ultralight':
-        from lightreal import LightReal,load_model,load_avatar,warm_up
+        from lightreal import LightReal,load_model,load_avatar,warm_up,infer_batch
         logger.info(opt)
         model = load_model(opt)
-        avatar = load_avatar(opt.avatar_id)
+        avatar = load_avatar(opt.avatar_id,opt.frame_cache_mb,opt.face_inputs_mb)
         warm_up(opt.batch_size,avatar,160)
+        infer_fn = partial(infer_batch,avatar[0])
+
+    if opt.shared_infer:
+        from inferscheduler import InferScheduler
+        scheduler = InferScheduler(infer_fn,max_batch_size=opt.batch_size*opt.max_session,max_wait=opt.infer_max_wait/1000)
 
     # if opt.transport=='rtmp':
     #     thread_quit = Event()
     #     nerfreals[0] = build_nerfreal(0)
     #     rendthrd = Thread(target=nerfreals[0].render,args=(thread_quit,))
     #     rendthrd.start()
+    if opt.session_pool > 0:
+        Thread(target=fill_pool, daemon=True).start()
+
     if opt.transport=='virtualcam':
         thread_quit = Event()
         nerfreals[0] = build_nerfreal(0)
@@ -468,6 +604,8 @@ if __name__ == '__main__':
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/interrupt_talk", interrupt_talk)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_post("/media_stats", media_stats)
+    appasync.router.add_get(r"/live/{sessionid:\d+}.flv", flv)
     appasync.router.add_static('/',path='web')
 
     # Configure default CORS settings.
@@ -487,6 +625,8 @@ if __name__ == '__main__':
         pagename='echoapi.html'
     elif opt.transport=='rtcpush':
         pagename='rtcpushapi.html'
+    elif opt.transport=='flv':
+        pagename='flvapi.html'
     logger.info('start http server; http://<serverip>:'+str(opt.listenport)+'/'+pagename)
     logger.info('如果使用webrtc，推荐访问webrtc集成前端: http://<serverip>:'+str(opt.listenport)+'/dashboard.html')
     def run_server(runner):
@@ -501,6 +641,9 @@ if __name__ == '__main__':
                 if k!=0:
                     push_url = opt.push_url+str(k)
                 loop.run_until_complete(run(push_url,k))
+        elif opt.transport=='flv':
+            for k in range(opt.max_session):
+                loop.run_until_complete(start_flv(k))
         loop.run_forever()    
     #Thread(target=run_server, args=(web.AppRunner(appasync),)).start()
     run_server(web.AppRunner(appasync))
@@ -0,0 +1,154 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# microbenchmark against torch.multiprocessing.Queue: python audioring.py
+
+import time
+import numpy as np
+
+import queue
+from threading import Event
+
+class AudioRing:
+    """
+    In-process single producer / single consumer queue of 20ms audio frames.
+
+    Drop-in for the queue of (frame,type,eventpoint) tuples between the asr and the inference
+    thread: pcm is copied into a preallocated float32 ring, type and eventpoint go to side
+    arrays, nothing is pickled. head is only written by the consumer and tail only by the
+    producer, so the data path takes no lock; the events are only used to sleep when the
+    ring is empty or full.
+
+    mute() is the barge-in path: speech frames already queued are still returned, to keep the
+    frame count the feature batches are aligned to, but as silence. generation counts the
+    mutes, a consumer reads it before taking frames to tell later whether they are stale.
+    """
+    def __init__(self, capacity, chunk):
+        self.capacity = capacity
+        self.chunk = chunk
+        self.buffer = np.zeros((capacity,chunk),dtype=np.float32)
+        self.lengths = np.zeros(capacity,dtype=np.int32)
+        self.types = np.zeros(capacity,dtype=np.int32)
+        self.eventpoints = [None]*capacity
+        self.head = 0 #next frame to read, monotonic
+        self.tail = 0 #next frame to write, monotonic
+        self.clear_mark = 0 #frames before this are dropped by the consumer
+        self.mute_mark = 0 #speech frames before this are returned as silence
+        self.generation = 0
+        self._not_empty = Event()
+        self._not_full = Event()
+
+    def qsize(self):
+        return self.tail - max(self.head,self.clear_mark)
+
+    def empty(self):
+        return self.qsize() <= 0
+
+    def clear(self):
+        """can be called from any thread, the consumer skips the dropped frames on its next get"""
+        self.clear_mark = self.tail
+        self._not_full.set()
+
+    def mute(self):
+        """can be called from any thread, speech frames queued so far come out as silence"""
+        self.mute_mark = self.tail
+        self.generation += 1
+
+    def put(self, item, block=True, timeout=None):
+        frame,type,eventpoint = item
+        if self.tail - self.head >= self.capacity:
+            self.__wait(self._not_full, lambda: self.tail - max(self.head,self.clear_mark) < self.capacity, block, timeout, queue.Full)
+        slot = self.tail % self.capacity
+        n = len(frame)
+        self.buffer[slot,:n] = frame
+        self.lengths[slot] = n
+        self.types[slot] = type
+        self.eventpoints[slot] = eventpoint
+        self.tail += 1 #publish
+        if not self._not_empty.is_set():
+            self._not_empty.set()
+
+    def get(self, block=True, timeout=None):
+        if self.clear_mark > self.head:
+            self.head = self.clear_mark
+        if self.tail <= self.head:
+            self.__wait(self._not_empty, lambda: self.tail > max(self.head,self.clear_mark), block, timeout, queue.Empty)
+            if self.clear_mark > self.head:
+                self.head = self.clear_mark
+        slot = self.head % self.capacity
+        if self.head < self.mute_mark and self.types[slot] == 0:
+            item = (np.zeros(self.lengths[slot],dtype=np.float32),1,None)
+        else:
+            item = (self.buffer[slot,:self.lengths[slot]].copy(),int(self.types[slot]),self.eventpoints[slot])
+        self.eventpoints[slot] = None
+        self.head += 1 #release the slot
+        if not self._not_full.is_set():
+            self._not_full.set()
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def __wait(self, event, ready, block, timeout, exc):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            event.clear()
+            if ready(): #re-check after clear so a put/get in between is not missed
+                return
+            if not block:
+                raise exc
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise exc
+            event.wait(remaining)
+
+
+def benchmark(sessions_list=(1,8,32), frames=5000, chunk=320):
+    """one producer and one consumer thread per session passing (frame,type,eventpoint) as fast as possible"""
+    from threading import Thread
+    import torch.multiprocessing as mp
+
+    def producer(q):
+        frame = np.zeros(chunk,dtype=np.float32)
+        for i in range(frames):
+            q.put((frame,i&1,None))
+
+    def consumer(q):
+        for _ in range(frames):
+            q.get()
+
+    def run(make_queue, sessions):
+        queues = [make_queue() for _ in range(sessions)]
+        threads = [Thread(target=producer,args=(q,)) for q in queues] + [Thread(target=consumer,args=(q,)) for q in queues]
+        t = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - t
+
+    for sessions in sessions_list:
+        for name,make_queue in [('mp.Queue',lambda: mp.Queue()),
+                                ('AudioRing',lambda: AudioRing(512,chunk))]:
+            elapsed = run(make_queue, sessions)
+            total = sessions*frames
+            print(f'{name:10s} sessions:{sessions:3d} {total/elapsed:10.0f} frames/s  {elapsed/frames*1e6:8.2f}us per frame per session')
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,113 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Packed avatar format, data/avatars/<avatar_id>/pack/:
+#   full_imgs.bin  face_imgs.bin  mask.bin   decoded uint8 BGR images stored back to back
+#   header.npz     per image (offset,h,w,c) tables of each .bin, coords, mask_coords, latents
+# The .bin files are opened with np.memmap, so startup does not decode any png and
+# several worker processes share the same page cache.
+#
+# convert an existing avatar: python avatarpack.py --avatar_id wav2lip256_avatar1
+
+import os
+import glob
+import pickle
+import argparse
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+from logger import logger
+
+IMAGE_DIRS = ['full_imgs','face_imgs','mask']
+
+def pack_path(avatar_path):
+    return os.path.join(avatar_path,'pack')
+
+def has_pack(avatar_path):
+    return os.path.exists(os.path.join(pack_path(avatar_path),'header.npz'))
+
+class PackedImages:
+    """read-only list of the images in one .bin file, indexed like the list returned by read_imgs"""
+    def __init__(self, path, table):
+        # copy-on-write: callers that draw on a frame only dirty their own pages
+        self.data = np.memmap(path, dtype=np.uint8, mode='c')
+        self.table = table # [N,4] offset,h,w,c
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, idx):
+        offset,h,w,c = self.table[idx]
+        return self.data[offset:offset+h*w*c].reshape(h,w,c)
+
+def load_pack(avatar_path):
+    """return dict with full_imgs/face_imgs/mask (PackedImages) and coords/mask_coords/latents if present"""
+    path = pack_path(avatar_path)
+    header = np.load(os.path.join(path,'header.npz'))
+    pack = {}
+    for name in IMAGE_DIRS:
+        if f'{name}_table' in header:
+            pack[name] = PackedImages(os.path.join(path,f'{name}.bin'),header[f'{name}_table'])
+    for name in ['coords','mask_coords']:
+        if name in header:
+            pack[name] = [tuple(coord) for coord in header[name].tolist()]
+    if 'latents' in header:
+        pack['latents'] = header['latents'] # [N,1,8,32,32]
+    logger.info(f'load packed avatar {avatar_path}: {len(pack["full_imgs"])} frames')
+    return pack
+
+def __sorted_imgs(img_dir):
+    img_list = glob.glob(os.path.join(img_dir, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+def build_pack(avatar_path):
+    path = pack_path(avatar_path)
+    os.makedirs(path,exist_ok=True)
+    header = {}
+    for name in IMAGE_DIRS:
+        img_list = __sorted_imgs(os.path.join(avatar_path,name))
+        if len(img_list) == 0:
+            continue
+        table = np.zeros((len(img_list),4),dtype=np.int64)
+        offset = 0
+        logger.info(f'packing {name}...')
+        with open(os.path.join(path,f'{name}.bin'),'wb') as f:
+            for i,img_path in enumerate(tqdm(img_list)):
+                img = cv2.imread(img_path)
+                f.write(np.ascontiguousarray(img).tobytes())
+                table[i] = (offset,) + img.shape
+                offset += img.size
+        header[f'{name}_table'] = table
+    for name in ['coords','mask_coords']:
+        coords_path = os.path.join(avatar_path,f'{name}.pkl')
+        if os.path.exists(coords_path):
+            with open(coords_path, 'rb') as f:
+                header[name] = np.array(pickle.load(f)).astype(np.int64)
+    latents_path = os.path.join(avatar_path,'latents.pt')
+    if os.path.exists(latents_path):
+        import torch
+        latents = torch.load(latents_path,map_location='cpu')
+        header['latents'] = torch.stack(latents).numpy()
+    np.savez(os.path.join(path,'header.npz'),**header)
+    logger.info(f'packed avatar saved to {path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avatar_id', type=str, default='avator_1', help="avatar in data/avatars to convert")
+    args = parser.parse_args()
+    build_pack(f"./data/avatars/{args.avatar_id}")
@@ -17,13 +17,39 @@
 
 import time
 import numpy as np
+import torch
 
 import queue
 from queue import Queue
-import torch.multiprocessing as mp
 
 from basereal import BaseReal
-
+from audioring import AudioRing
+
+
+class FeatBatchPool:
+    """
+    Round-robin pool of reusable [batch,...] float32 feature buffers, pinned when cuda is available.
+
+    The asr writes each batch of chunks into the next buffer and the inference thread uses it
+    without stacking. feat_queue holds maxsize batches, the asr fills one more and the inference
+    thread works on one, so with size=maxsize+2 a buffer is never rewritten while still in use.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buffers = None
+        self.index = 0
+
+    def fill(self, chunks):
+        shape = (len(chunks),) + np.shape(chunks[0])
+        if self.buffers is None or tuple(self.buffers[0].shape) != shape:
+            pin = torch.cuda.is_available()
+            self.buffers = [torch.empty(shape, dtype=torch.float32, pin_memory=pin) for _ in range(self.size)]
+        buffer = self.buffers[self.index]
+        self.index = (self.index + 1) % self.size
+        view = buffer.numpy() #shares memory with the tensor
+        for i,chunk in enumerate(chunks):
+            view[i] = chunk
+        return buffer
 
 class BaseASR:
     def __init__(self, opt, parent:BaseReal = None):
@@ -33,8 +59,7 @@ class BaseASR:
         self.fps = opt.fps # 20 ms per frame
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
-        self.queue = Queue()
-        self.output_queue = mp.Queue()
+        self.queue = Queue() #several producers (tts, uploaded audio), stays unbounded
 
         self.batch_size = opt.batch_size
 
@@ -42,12 +67,29 @@ class BaseASR:
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
         #self.context_size = 10
-        self.feat_queue = mp.Queue(2)
+        # asr and inference are threads of the same process, no need to pickle through mp.Queue
+        # feat_queue holds at most 2 batches, so the output frames in flight stay well below this capacity
+        self.output_queue = AudioRing(self.batch_size*2*8+self.stride_left_size+self.stride_right_size,self.chunk)
+        self.feat_queue = Queue(2)
+        self.feat_pool = FeatBatchPool(self.feat_queue.maxsize+2)
 
         #self.warm_up()
 
     def flush_talk(self):
         self.queue.queue.clear()
+        self.output_queue.mute() #queued speech turns into silence, the inference skips the model for it
+
+    def reset(self):
+        """drop all buffered audio/features and warm up again, used when a pooled session is reused"""
+        self.queue.queue.clear()
+        for q in (self.output_queue,self.feat_queue):
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+        self.frames = []
+        self.warm_up()
 
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
         self.queue.put((audio_chunk,eventpoint))
@@ -84,5 +126,8 @@ class BaseASR:
     def run_step(self):
         pass
 
+    def put_feat(self,chunks):
+        self.feat_queue.put(self.feat_pool.fill(chunks))
+
     def get_next_feat(self,block,timeout):        
         return self.feat_queue.get(block,timeout)
\ No newline at end of file
@@ -25,6 +25,7 @@ import time
 import cv2
 import glob
 import resampy
+import weakref
 
 import queue
 from queue import Queue
@@ -39,6 +40,8 @@ import av
 from fractions import Fraction
 
 from ttsreal import EdgeTTS,SovitsTTS,XTTS,CosyVoiceTTS,FishTTS,TencentTTS,DoubaoTTS
+from customclip import get_custom_clip_store
+from flowcontrol import FrameCredits
 from logger import logger
 
 from tqdm import tqdm
@@ -50,6 +53,47 @@ def read_imgs(img_list):
         frames.append(frame)
     return frames
 
+def speech_frames(audio_frames,batch_size):
+    '''index of the video frames in a batch that have speech in any of their 2 audio frames'''
+    return [i for i in range(batch_size) if audio_frames[i*2][1]==0 or audio_frames[i*2+1][1]==0]
+
+def pad_to_bucket(frames,batch_size):
+    '''pad the frame indices with the last one to the next power of 2 (at most batch_size), so the model only sees a few batch shapes'''
+    size = 1
+    while size < len(frames):
+        size *= 2
+    size = min(size,batch_size)
+    return frames + [frames[-1]]*(size-len(frames))
+
+def select_frames(batch,sel):
+    '''sub-batch of a feature batch, the batch buffer itself is used when every frame is selected'''
+    if sel == list(range(len(batch))):
+        return batch
+    return batch[sel]
+
+def face_inputs_to_device(face_inputs, device, max_mb):
+    """
+    [N,6,H,W] uint8 face inputs as a tensor, one copy shared by all sessions of the avatar.
+    On the inference device if it is at most max_mb (and, for cuda, a quarter of the free
+    memory), otherwise kept in host memory and each batch uploads only its own frames.
+    """
+    tensor = torch.from_numpy(face_inputs)
+    mb = tensor.nbytes / 1024**2
+    fits = mb <= max_mb
+    if fits and device == 'cuda':
+        free, _ = torch.cuda.mem_get_info()
+        fits = tensor.nbytes <= free // 4
+    if fits or device == 'cpu':
+        logger.info(f'face inputs {mb:.0f}MB on {device}')
+        return tensor.to(device)
+    logger.info(f'face inputs {mb:.0f}MB above --face_inputs_mb {max_mb} or free memory, kept in host memory and uploaded per batch')
+    return tensor.pin_memory() if device == 'cuda' else tensor
+
+def mute_audio_frames(audio_frames):
+    '''speech frames of an interrupted generation as silence, custom audio is kept'''
+    return [(np.zeros_like(frame),1,None) if type==0 else (frame,type,eventpoint)
+            for frame,type,eventpoint in audio_frames]
+
 def play_audio(quit_event,queue):        
     import pyaudio
     p = pyaudio.PyAudio()
@@ -104,6 +148,13 @@ class BaseReal:
         self.custom_opt = {}
         self.__loadcustom()
 
+        self.worker_threads = [] #threads started by render, joined before the instance is reused
+        self.interrupt_time = {} #kind:time of the last flush_talk, until that output went quiet
+        self.media_stats = {} #jitter buffer depth and a/v drift of the webrtc tracks
+        # video frames at 25fps the render loop may have in flight, granted back by the output
+        budget = getattr(opt,'latency_budget',0)*opt.fps//2//1000 or 3*opt.batch_size
+        self.credits = FrameCredits(budget,opt.batch_size)
+
     def put_msg_txt(self,msg,eventpoint=None):
         self.tts.put_msg_txt(msg,eventpoint)
     
@@ -136,23 +187,64 @@ class BaseReal:
 
         return stream
 
+    @property
+    def generation(self):
+        '''bumped by flush_talk, speech tagged with an older generation is dropped by every stage'''
+        return self.asr.output_queue.generation
+
     def flush_talk(self):
+        t = time.perf_counter()
+        self.interrupt_time = {'audio':t,'video':t}
         self.tts.flush_talk()
         self.asr.flush_talk()
 
+    def report_interrupt(self,kind):
+        '''called by the output for every frame, logs the interrupt-to-silence latency once after flush_talk'''
+        t = self.interrupt_time.pop(kind,None)
+        if t is not None:
+            logger.info(f'interrupt to {kind} silence: {(time.perf_counter()-t)*1000:.1f}ms')
+
     def is_speaking(self)->bool:
         return self.speaking
     
     def __loadcustom(self):
+        # clips are shared by all sessions, only the play positions are per session
+        store = get_custom_clip_store()
+        keys = []
         for item in self.opt.customopt:
             logger.info(item)
-            input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
-            input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-            self.custom_img_cycle[item['audiotype']] = read_imgs(input_img_list)
-            self.custom_audio_cycle[item['audiotype']], sample_rate = sf.read(item['audiopath'], dtype='float32')
+            clip = store.acquire(item,self.sample_rate)
+            keys.append(store.key(item,self.sample_rate))
+            self.custom_img_cycle[item['audiotype']] = clip.imgs
+            self.custom_audio_cycle[item['audiotype']] = clip.audio
             self.custom_audio_index[item['audiotype']] = 0
             self.custom_index[item['audiotype']] = 0
             self.custom_opt[item['audiotype']] = item
+        weakref.finalize(self,store.release,keys)
+
+    def reset(self)->bool:
+        """reset per-session state so that a pooled instance can serve a new connection.
+        return False if the threads of the previous session did not stop in time"""
+        for thread in self.worker_threads:
+            thread.join(timeout=3)
+        if any(thread.is_alive() for thread in self.worker_threads):
+            logger.warning(f'session {self.sessionid} threads still running, not reusable')
+            return False
+        self.worker_threads = []
+        self.stop_recording()
+        self.tts.reset()
+        self.asr.reset()
+        while True:
+            try:
+                self.res_frame_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.speaking = False
+        self.interrupt_time = {}
+        self.media_stats = {}
+        self.credits.reset()
+        self.init_customindex()
+        return True
 
     def init_customindex(self):
         self.curr_state=0
@@ -180,7 +272,7 @@ class BaseReal:
                     '-pix_fmt', 'yuv420p', 
                     '-vcodec', "h264",
                     #'-f' , 'flv',                  
-                    f'temp{self.opt.sessionid}.mp4']
+                    f'temp{self.sessionid}.mp4']
         self._record_video_pipe = subprocess.Popen(command, shell=False, stdin=subprocess.PIPE)
 
         acommand = ['ffmpeg',
@@ -192,7 +284,7 @@ class BaseReal:
                     '-i', '-',
                     '-acodec', 'aac',
                     #'-f' , 'wav',                  
-                    f'temp{self.opt.sessionid}.aac']
+                    f'temp{self.sessionid}.aac']
         self._record_audio_pipe = subprocess.Popen(acommand, shell=False, stdin=subprocess.PIPE)
 
         self.recording = True
@@ -263,7 +355,7 @@ class BaseReal:
         self._record_video_pipe.wait()
         self._record_audio_pipe.stdin.close()
         self._record_audio_pipe.wait()
-        cmd_combine_audio = f"ffmpeg -y -i temp{self.opt.sessionid}.aac -i temp{self.opt.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
+        cmd_combine_audio = f"ffmpeg -y -i temp{self.sessionid}.aac -i temp{self.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
         os.system(cmd_combine_audio) 
         #os.remove(output_path)
 
@@ -310,12 +402,17 @@ class BaseReal:
             audio_tmp = queue.Queue(maxsize=3000)
             audio_thread = Thread(target=play_audio, args=(quit_event,audio_tmp,), daemon=True, name="pyaudio_stream")
             audio_thread.start()
+        else:
+            from webrtc import put_frames
         
         while not quit_event.is_set():
             try:
-                res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
+                res_frame,idx,audio_frames,generation = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            if generation != self.generation: #interrupted after inference, show the idle frame of the same index
+                res_frame = None
+                audio_frames = mute_audio_frames(audio_frames)
             
             if enable_transition:
                 # 检测状态变化
@@ -350,9 +447,9 @@ class BaseReal:
                 self.speaking = True
                 try:
                     current_frame = self.paste_back_frame(res_frame,idx)
-                except Exception as e:
+                except Exception as e: #send the idle frame, so the frame still goes out and returns its credit
                     logger.warning(f"paste_back_frame error: {e}")
-                    continue
+                    current_frame = self.frame_list_cycle[idx]
                 if enable_transition:
                     # 静音→说话过渡
                     if time.time() - _transition_start < _transition_duration and _last_silent_frame is not None:
@@ -374,9 +471,10 @@ class BaseReal:
             else: #webrtc
                 image = combine_frame
                 new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-                asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                video_item = (new_frame,None,generation if self.speaking else None)
             self.record_video_data(combine_frame)
 
+            audio_items = []
             for audio_frame in audio_frames:
                 frame,type,eventpoint = audio_frame
                 frame = (frame * 32767).astype(np.int16)
@@ -387,10 +485,15 @@ class BaseReal:
                     new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                     new_frame.planes[0].update(frame.tobytes())
                     new_frame.sample_rate=16000
-                    asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                    audio_items.append((new_frame,eventpoint,generation if type==0 else None))
                 self.record_audio_data(frame)
-            if self.opt.transport=='virtualcam':
+            if self.opt.transport!='virtualcam': #one loop wakeup for the video frame and its audio
+                put_frames(loop,[(video_track._queue,[video_item]),(audio_track._queue,audio_items)])
+            else:
+                self.report_interrupt('video')
+                self.report_interrupt('audio')
                 vircam.sleep_until_next_frame()
+                self.credits.grant()
         if self.opt.transport=='virtualcam':
             audio_thread.join()
             vircam.close()
@@ -0,0 +1,220 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Broadcast session: one BaseReal rendered and H264-encoded once, sent to many viewers.
+# create: POST /offer {"broadcast": true, ...}, join: POST /offer {"attach": <sessionid>, ...}
+# fan-out cost per viewer vs one encoder per viewer: python broadcast.py
+
+import asyncio
+import time
+from collections import deque
+from typing import Set
+
+import av
+from aiortc import MediaStreamTrack
+
+from webrtc import HumanPlayer, VIDEO_TIME_BASE, VIDEO_PTIME
+from logger import logger
+
+RELAY_DEPTH = 50 #frames buffered per viewer, a viewer that falls further behind loses the oldest
+H264_OPTIONS = {'profile': 'baseline', 'level': '31', 'tune': 'zerolatency', 'preset': 'ultrafast'}
+
+def create_h264_encoder(width, height, bitrate=1000000):
+    '''libx264 settings of aiortc's own H264 encoder, so every browser that negotiated H264 can decode it'''
+    codec = av.CodecContext.create('libx264', 'w')
+    codec.width = width
+    codec.height = height
+    codec.pix_fmt = 'yuv420p'
+    codec.framerate = int(1 / VIDEO_PTIME)
+    codec.time_base = VIDEO_TIME_BASE
+    codec.bit_rate = bitrate
+    codec.gop_size = 2 * int(1 / VIDEO_PTIME) #a late joiner waits at most 2s for a keyframe
+    codec.options = H264_OPTIONS
+    return codec
+
+def force_keyframe(frame):
+    try:
+        frame.pict_type = av.video.frame.PictureType.I
+    except AttributeError: #older pyav
+        frame.pict_type = 'I'
+
+class RelayTrack(MediaStreamTrack):
+    """
+    Track of one viewer. recv returns what the hub pushed: H264 packets for video, which the
+    sender only packetizes, and the shared audio frames.
+    """
+    def __init__(self, kind):
+        super().__init__()
+        self.kind = kind
+        self._items = deque()
+        self._waiter = None
+        self.waiting_keyframe = kind == 'video'
+
+    def push(self, item, keyframe=False):
+        if self.waiting_keyframe:
+            if not keyframe:
+                return
+            self.waiting_keyframe = False
+        if len(self._items) >= RELAY_DEPTH:
+            self._items.clear()
+            if self.kind == 'video': #later packets reference the dropped ones
+                self.waiting_keyframe = not keyframe
+                if self.waiting_keyframe:
+                    return
+        self._items.append(item)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def recv(self):
+        while not self._items:
+            if self.readyState != 'live':
+                raise Exception
+            self._waiter = asyncio.get_event_loop().create_future()
+            await self._waiter
+        return self._items.popleft()
+
+    def stop(self):
+        super().stop()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+class BroadcastViewer:
+    def __init__(self):
+        self.audio = RelayTrack('audio')
+        self.video = RelayTrack('video')
+
+class BroadcastHub:
+    """
+    Pulls the paced audio/video of one session's HumanPlayer, encodes each video frame once
+    and pushes the same packets to every viewer. Audio frames are shared as they are, each
+    sender only runs the (cheap) opus encoder. Joining viewers start at the next keyframe,
+    which is forced right away.
+    """
+    def __init__(self, nerfreal):
+        self.nerfreal = nerfreal
+        self.player = HumanPlayer(nerfreal)
+        self.viewers: Set[BroadcastViewer] = set()
+        self.encoder = None
+        self.keyframe = False
+        self.encode_time = 0.
+        self.frames = 0
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self.__pump_audio()), loop.create_task(self.__pump_video())]
+
+    def subscribe(self) -> BroadcastViewer:
+        viewer = BroadcastViewer()
+        self.viewers.add(viewer)
+        self.keyframe = True
+        logger.info(f'broadcast {self.nerfreal.sessionid}: {len(self.viewers)} viewers')
+        return viewer
+
+    def unsubscribe(self, viewer) -> int:
+        '''return the number of viewers left'''
+        self.viewers.discard(viewer)
+        viewer.audio.stop()
+        viewer.video.stop()
+        logger.info(f'broadcast {self.nerfreal.sessionid}: {len(self.viewers)} viewers')
+        return len(self.viewers)
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.player.audio.stop()
+        self.player.video.stop()
+
+    async def __pump_audio(self):
+        while True:
+            try:
+                frame = await self.player.audio.recv()
+            except Exception: #source track stopped
+                return
+            for viewer in list(self.viewers):
+                viewer.audio.push(frame)
+
+    def __encode(self, frame, keyframe):
+        t = time.perf_counter()
+        if self.encoder is None:
+            self.encoder = create_h264_encoder(frame.width, frame.height)
+        pts = frame.pts
+        frame = frame.reformat(format='yuv420p')
+        frame.pts = pts
+        if keyframe:
+            force_keyframe(frame)
+        packets = self.encoder.encode(frame)
+        for packet in packets:
+            packet.time_base = VIDEO_TIME_BASE
+        self.encode_time += time.perf_counter() - t
+        self.frames += 1
+        if self.frames % 250 == 0:
+            logger.info(f'broadcast {self.nerfreal.sessionid}: {len(self.viewers)} viewers, encode {self.encode_time/self.frames*1000:.2f}ms/frame')
+        return packets
+
+    async def __pump_video(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                frame = await self.player.video.recv()
+            except Exception:
+                return
+            pts = frame.pts
+            keyframe, self.keyframe = self.keyframe, False
+            packets = await loop.run_in_executor(None, self.__encode, frame, keyframe)
+            for packet in packets:
+                if packet.pts is None:
+                    packet.pts = pts
+                for viewer in list(self.viewers):
+                    viewer.video.push(packet, packet.is_keyframe)
+
+
+def benchmark_fanout(viewers_list=(1, 10, 50), seconds=5, width=512, height=512):
+    '''
+    cpu per second of video for one shared encoder fanning packets out to n viewers vs one
+    encoder per viewer (what n separate sessions cost). Transport is not included.
+    '''
+    import numpy as np
+    from av import VideoFrame
+
+    fps = int(1 / VIDEO_PTIME)
+    images = [np.random.randint(0, 255, (height, width, 3), dtype=np.uint8) for _ in range(10)]
+
+    def run(viewers, shared):
+        encoders = [create_h264_encoder(width, height) for _ in range(1 if shared else viewers)]
+        tracks = [RelayTrack('video') for _ in range(viewers)]
+        t = time.process_time()
+        for i in range(seconds * fps):
+            frame = VideoFrame.from_ndarray(images[i % len(images)], format='bgr24').reformat(format='yuv420p')
+            frame.pts = i * int(VIDEO_PTIME * 90000)
+            if shared:
+                for packet in encoders[0].encode(frame):
+                    for track in tracks:
+                        track.push(packet, packet.is_keyframe)
+            else:
+                for encoder, track in zip(encoders, tracks):
+                    for packet in encoder.encode(frame):
+                        track.push(packet, packet.is_keyframe)
+            for track in tracks:
+                track._items.clear()
+        return (time.process_time() - t) / seconds
+
+    for viewers in viewers_list:
+        shared = run(viewers, True)
+        separate = run(viewers, False)
+        print(f'{viewers:3d} viewers: shared encoder {shared*100:6.1f}% of a core ({shared/viewers*1000:6.2f}ms/s per viewer)'
+              f'   encoder per viewer {separate*100:6.1f}% ({separate/viewers*1000:6.2f}ms/s per viewer)')
+
+if __name__ == '__main__':
+    benchmark_fanout()
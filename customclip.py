@@ -0,0 +1,86 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import glob
+import cv2
+import numpy as np
+import soundfile as sf
+import resampy
+from threading import Lock
+from tqdm import tqdm
+
+from logger import logger
+
+class CustomClip:
+    """
+    Images and audio of one customvideo_config entry, decoded once and shared by all sessions.
+
+    The images are drawn on like the avatar frames, the audio is resampled to sample_rate
+    and read-only. Sessions only keep their own play positions.
+    """
+    def __init__(self, item, sample_rate):
+        img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
+        img_list = sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        logger.info(f"loading custom clip {item['audiotype']}: {len(img_list)} images")
+        self.imgs = [cv2.imread(img_path) for img_path in tqdm(img_list)]
+
+        audio, sr = sf.read(item['audiopath'], dtype='float32')
+        if audio.ndim > 1:
+            logger.info(f"custom audio {item['audiopath']} has {audio.shape[1]} channels, only use the first.")
+            audio = audio[:, 0]
+        if sr != sample_rate and audio.shape[0] > 0:
+            logger.info(f"custom audio {item['audiopath']} sample rate is {sr}, resampling into {sample_rate}.")
+            audio = resampy.resample(x=audio, sr_orig=sr, sr_new=sample_rate).astype(np.float32)
+        self.audio = np.ascontiguousarray(audio)
+        self.audio.flags.writeable = False
+
+class CustomClipStore:
+    """process wide reference counted CustomClips, keyed by (imgpath, audiopath, sample_rate)"""
+    def __init__(self):
+        self.clips = {} # key:[clip, refcount]
+        self.lock = Lock()
+
+    @staticmethod
+    def key(item, sample_rate):
+        return (item['imgpath'], item['audiopath'], sample_rate)
+
+    def acquire(self, item, sample_rate):
+        key = self.key(item, sample_rate)
+        with self.lock: # sessions built at the same time wait for the first one to decode
+            entry = self.clips.get(key)
+            if entry is None:
+                entry = [CustomClip(item, sample_rate), 0]
+                self.clips[key] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, keys):
+        with self.lock:
+            for key in keys:
+                entry = self.clips.get(key)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.clips[key]
+                    logger.info(f'custom clip {key[0]} released')
+
+_clip_store = CustomClipStore()
+
+def get_custom_clip_store():
+    return _clip_store
@@ -0,0 +1,54 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from threading import Condition
+
+from logger import logger
+
+class FrameCredits:
+    """
+    Credit based flow control between the output of a session and its render loop.
+
+    The render loop takes batch_size credits, one per video frame, before each asr.run_step
+    and the output grants one back for every video frame that leaves its buffer (sent,
+    dropped or skipped). budget credits exist in total, so no more than budget video frames
+    are ever in flight between the asr and the viewer, whichever queue they sit in, and the
+    render loop sleeps on the condition instead of polling.
+    """
+    def __init__(self, budget, batch_size):
+        if budget < 2*batch_size:
+            logger.warning(f'latency budget of {budget} frames is below 2 batches ({2*batch_size}), inference can not overlap playback')
+        self.budget = max(budget, batch_size) #a batch must fit or the render loop never runs
+        self.credits = self.budget
+        self.cond = Condition()
+
+    def acquire(self, n, timeout=None) -> bool:
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.credits >= n, timeout):
+                return False
+            self.credits -= n
+            return True
+
+    def grant(self, n=1):
+        with self.cond:
+            self.credits = min(self.budget, self.credits + n)
+            self.cond.notify_all()
+
+    def reset(self):
+        with self.cond:
+            self.credits = self.budget
+            self.cond.notify_all()
@@ -0,0 +1,241 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# HTTP-FLV output (--transport flv): each session is encoded once (h264 + aac) by an
+# encoder thread and the flv byte stream is served to any number of clients at
+# GET /live/{sessionid}.flv, played in the browser with web/mpegts-1.7.3.min.js
+
+import asyncio
+import queue
+import time
+from collections import deque
+from fractions import Fraction
+from threading import Thread, Event
+
+import av
+from aiohttp import web
+
+from webrtc import HumanPlayer, VIDEO_PTIME, SAMPLE_RATE
+from broadcast import H264_OPTIONS
+from logger import logger
+
+FLV_CLIENT_DEPTH = 250 #tags buffered per client (~3s), a client that falls further behind resyncs at the next keyframe
+
+FLV_AUDIO = 8
+FLV_VIDEO = 9
+FLV_SCRIPT = 18
+
+class FlvTagReader:
+    """
+    File object the flv muxer writes into. tags() returns the 13 byte file header once,
+    then every complete tag (with its trailing PreviousTagSize).
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.header_done = False
+
+    def write(self, data):
+        self.buf += data
+        return len(data)
+
+    def tags(self):
+        tags = []
+        if not self.header_done:
+            if len(self.buf) < 13:
+                return tags
+            tags.append(bytes(self.buf[:13]))
+            del self.buf[:13]
+            self.header_done = True
+        while len(self.buf) >= 11:
+            size = 11 + int.from_bytes(self.buf[1:4], 'big') + 4
+            if len(self.buf) < size:
+                break
+            tags.append(bytes(self.buf[:size]))
+            del self.buf[:size]
+        return tags
+
+class FlvClient:
+    def __init__(self, waiting_keyframe):
+        self.tags = deque()
+        self.waiter = None
+        self.waiting_keyframe = waiting_keyframe
+        self.closed = False
+
+    def push(self, tag, keyframe=False):
+        if self.waiting_keyframe:
+            if not keyframe:
+                return
+            self.waiting_keyframe = False
+        if len(self.tags) >= FLV_CLIENT_DEPTH:
+            self.tags.clear() #later tags reference the dropped ones
+            self.waiting_keyframe = not keyframe
+            if self.waiting_keyframe:
+                return
+        self.tags.append(tag)
+        self.__wake()
+
+    def close(self):
+        self.closed = True
+        self.__wake()
+
+    def __wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self):
+        '''all buffered tags in one chunk, None once closed'''
+        while not self.tags:
+            if self.closed:
+                return None
+            self.waiter = asyncio.get_event_loop().create_future()
+            await self.waiter
+        data = b''.join(self.tags)
+        self.tags.clear()
+        return data
+
+class FlvStream:
+    """
+    Pulls the paced audio/video of one session's HumanPlayer, encodes and muxes it into flv
+    in an encoder thread and fans the tags out to the http clients on the event loop.
+
+    header holds the flv file header, metadata and the avc/aac sequence headers, gop the
+    tags since the last video keyframe, so a client that joins late starts playing at once
+    from header + gop.
+    """
+    def __init__(self, nerfreal):
+        self.nerfreal = nerfreal
+        self.player = HumanPlayer(nerfreal)
+        self.fps = int(1 / VIDEO_PTIME)
+        self.frames = queue.Queue(maxsize=2*self.fps)
+        self.header = b''
+        self.gop = []
+        self.clients = set()
+        self.loop = asyncio.get_event_loop()
+        self.quit_event = Event()
+        self.thread = Thread(target=self.__encode_thread, name=f'flv-{nerfreal.sessionid}', daemon=True)
+        self.thread.start()
+        self.tasks = [self.loop.create_task(self.__pump(self.player.audio)),
+                      self.loop.create_task(self.__pump(self.player.video))]
+
+    async def __pump(self, track):
+        while True:
+            try:
+                frame = await track.recv()
+            except Exception: #source track stopped
+                return
+            try:
+                self.frames.put_nowait((track.kind, frame, frame.pts))
+            except queue.Full:
+                logger.warning(f'flv {self.nerfreal.sessionid}: encoder behind, drop {track.kind} frame')
+
+    def __open(self, reader, width, height):
+        container = av.open(reader, mode='w', format='flv')
+        video = container.add_stream('libx264', rate=self.fps)
+        video.width = width
+        video.height = height
+        video.pix_fmt = 'yuv420p'
+        video.bit_rate = 1000000
+        video.codec_context.gop_size = self.fps #a late joiner is at most 1s behind live
+        video.options = H264_OPTIONS
+        audio = container.add_stream('aac', rate=SAMPLE_RATE)
+        audio.layout = 'mono'
+        return container, video, audio
+
+    def __encode_thread(self):
+        reader = FlvTagReader()
+        container = None
+        encode_time = 0.
+        count = 0
+        while not self.quit_event.is_set():
+            try:
+                kind, frame, pts = self.frames.get(timeout=1)
+            except queue.Empty:
+                continue
+            if container is None:
+                if kind != 'video': #streams are created from the first video frame
+                    continue
+                container, video, audio = self.__open(reader, frame.width, frame.height)
+            t = time.perf_counter()
+            if kind == 'video': #a repeated frame is queued more than once, encode a copy
+                time_base = frame.time_base
+                frame = frame.reformat(format='yuv420p')
+                frame.pts = round(pts * time_base * self.fps)
+                frame.time_base = Fraction(1, self.fps)
+                packets = video.encode(frame)
+                count += 1
+            else:
+                packets = audio.encode(frame)
+            for packet in packets:
+                container.mux(packet)
+            encode_time += time.perf_counter() - t
+            tags = reader.tags()
+            if tags:
+                self.loop.call_soon_threadsafe(self.__publish, tags)
+            if kind == 'video' and count % 250 == 0:
+                logger.info(f'flv {self.nerfreal.sessionid}: {len(self.clients)} clients, encode {encode_time/count*1000:.2f}ms/frame')
+        if container is not None:
+            container.close()
+
+    def __publish(self, tags):
+        for tag in tags:
+            kind = tag[0] & 0x1f
+            if tag[:3] == b'FLV' or kind == FLV_SCRIPT or (kind in (FLV_AUDIO, FLV_VIDEO) and tag[12] == 0):
+                self.header += tag #file header, metadata, sequence headers
+                continue
+            keyframe = kind == FLV_VIDEO and tag[11] >> 4 == 1
+            if keyframe:
+                self.gop = [tag]
+            elif self.gop:
+                self.gop.append(tag)
+            for client in list(self.clients):
+                client.push(tag, keyframe)
+
+    async def serve(self, request):
+        response = web.StreamResponse(headers={'Content-Type': 'video/x-flv', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        # late joiners start from the cached gop, the first ones wait for the first keyframe
+        head = self.header + b''.join(self.gop) if self.gop else None
+        client = FlvClient(waiting_keyframe=head is None)
+        self.clients.add(client)
+        logger.info(f'flv {self.nerfreal.sessionid}: {len(self.clients)} clients')
+        try:
+            if head is None: #the header is complete once the first keyframe is out
+                data = await client.get()
+                if data is None:
+                    return response
+                head = self.header + data
+            await response.write(head)
+            while True:
+                data = await client.get()
+                if data is None:
+                    break
+                await response.write(data)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.clients.discard(client)
+            logger.info(f'flv {self.nerfreal.sessionid}: {len(self.clients)} clients')
+        return response
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.quit_event.set()
+        for client in list(self.clients):
+            client.close()
+        self.player.audio.stop()
+        self.player.video.stop()
@@ -2,7 +2,8 @@ import time
 import torch
 import numpy as np
 from baseasr import BaseASR
-from ultralight.audio2feature import Audio2Feature
+from ultralight.audio2feature import Audio2Feature,HubertFeatureCache
+from logger import logger
 
 # hubert audio feature
 class HubertASR(BaseASR):
@@ -13,8 +14,20 @@ class HubertASR(BaseASR):
         #self.stride_left_size = 32
         #self.stride_right_size = 32
         self.audio_feat_length = audio_feat_length
+        self.feat_cache = None
+        if getattr(opt, 'hubert_cache', False):
+            self.feat_cache = HubertFeatureCache(audio_processor, self.stride_left_size + self.stride_right_size,
+                                                 drift_interval=getattr(opt, 'hubert_cache_drift', 0))
+            if not self.feat_cache.enabled:
+                logger.warning(f'hubert cache: l+r={self.stride_left_size + self.stride_right_size} frames of overlap leave nothing to reuse, encoding full windows')
+        self.step_count = 0
 
 
+    def reset(self):
+        if self.feat_cache is not None:
+            self.feat_cache.reset()
+        super().reset()
+
     def run_step(self):
         start_time = time.time()
         
@@ -28,10 +41,17 @@ class HubertASR(BaseASR):
         
         inputs = np.concatenate(self.frames)  # [N * chunk]
 
-        mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
+        if self.feat_cache is not None:
+            mel = self.feat_cache.get_hubert_from_16k_speech(inputs,self.batch_size*2*self.chunk)
+            self.step_count += 1
+            if self.step_count % 100 == 0:
+                drift = f" drift:{self.feat_cache.drift:.4f}" if self.feat_cache.drift_interval > 0 else ""
+                logger.info(f"hubert cache size:{self.feat_cache.cache_size} hit rate:{self.feat_cache.hit_rate:.4f}{drift}")
+        else:
+            mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
         mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
 
-        self.feat_queue.put(mel_chunks)
+        self.put_feat(mel_chunks)
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
         #print(f"Processing audio costs {(time.time() - start_time) * 1000}ms")
 
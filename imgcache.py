@@ -0,0 +1,162 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import cv2
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+from queue import Queue
+
+from logger import logger
+
+class ImgCache:
+    """
+    Lazily decoded image list with a byte-budgeted LRU.
+
+    Indexed like the list returned by read_imgs. Frames are walked with mirror_index, so
+    after each access the next `readahead` indices in the walk direction (bouncing at both
+    ends) are decoded by a background thread. Sessions sharing the cache each read through
+    their own reader() so they keep their own walk direction. An image is decoded at most
+    once at a time, a miss on an image the readahead is decoding waits for it.
+    """
+    def __init__(self, img_list, max_bytes, readahead=8):
+        self.img_list = img_list
+        self.max_bytes = max_bytes
+        self.readahead = readahead
+        self.cache = OrderedDict() # idx:image, most recently used last
+        self.nbytes = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.last_idx = 0 # walk of reads through the cache itself
+        self.direction = 1
+        self.pending = {} # idx:Event of the decodes in flight
+        self.queued = set()
+        self.readahead_queue = Queue()
+        Thread(target=self.__readahead_worker, daemon=True, name="imgcache_readahead").start()
+
+    def __len__(self):
+        return len(self.img_list)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def reader(self):
+        return ImgCacheReader(self)
+
+    def __getitem__(self, idx):
+        return self.get(idx, self)
+
+    def get(self, idx, walk):
+        """image idx, walk (a reader) holds last_idx/direction of the caller"""
+        img, hit = self.__fetch(idx)
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.__schedule_readahead(idx, walk)
+        if (self.hits + self.misses) % 1000 == 0:
+            logger.info(f'imgcache {len(self.cache)} imgs {self.nbytes/1024**2:.1f}MB hit rate:{self.hit_rate:.4f} misses:{self.misses}')
+        return img
+
+    def __fetch(self, idx):
+        # return (image, cache hit); concurrent misses on one index share a single decode
+        with self.lock:
+            img = self.cache.get(idx)
+            if img is not None:
+                self.cache.move_to_end(idx)
+                return img, True
+            event = self.pending.get(idx)
+            owner = event is None
+            if owner:
+                event = self.pending[idx] = Event()
+        if not owner:
+            event.wait()
+            with self.lock:
+                img = self.cache.get(idx)
+            if img is not None:
+                return img, False
+            return self.__load(idx), False # evicted already or the decode failed
+        try:
+            return self.__load(idx), False
+        finally:
+            with self.lock:
+                del self.pending[idx]
+            event.set()
+
+    def __load(self, idx):
+        img = cv2.imread(self.img_list[idx])
+        if img is None:
+            raise IOError(f'imgcache: can not read image {self.img_list[idx]}')
+        with self.lock:
+            if idx not in self.cache:
+                self.cache[idx] = img
+                self.nbytes += img.nbytes
+                while self.nbytes > self.max_bytes and len(self.cache) > 1:
+                    _, old = self.cache.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return img
+
+    def __next_index(self, idx, step, direction):
+        # continue the mirror walk: reverse direction at both ends
+        size = len(self.img_list)
+        pos = idx + step*direction
+        if pos >= size:
+            pos = 2*size - pos - 1
+        elif pos < 0:
+            pos = -pos - 1
+        return max(0, min(size-1, pos))
+
+    def __schedule_readahead(self, idx, walk):
+        diff = idx - walk.last_idx
+        if diff != 0 and abs(diff) <= self.readahead:
+            walk.direction = 1 if diff > 0 else -1
+        walk.last_idx = idx
+        for step in range(1, self.readahead+1):
+            nidx = self.__next_index(idx, step, walk.direction)
+            with self.lock:
+                if nidx in self.cache or nidx in self.pending or nidx in self.queued:
+                    continue
+                self.queued.add(nidx)
+            self.readahead_queue.put(nidx)
+
+    def __readahead_worker(self):
+        while True:
+            idx = self.readahead_queue.get()
+            try:
+                self.__fetch(idx)
+            except Exception:
+                logger.exception('imgcache readahead')
+            finally:
+                with self.lock:
+                    self.queued.discard(idx)
+
+class ImgCacheReader:
+    """view of an ImgCache with its own walk direction, one per session"""
+    def __init__(self, cache:ImgCache):
+        self.cache = cache
+        self.last_idx = 0
+        self.direction = 1
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx):
+        return self.cache.get(idx, self)
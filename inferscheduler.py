@@ -0,0 +1,144 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import time
+import numpy as np
+import torch
+
+import queue
+from queue import Queue
+from threading import Thread, Lock
+from concurrent.futures import Future
+
+from logger import logger
+
+def _concat(items):
+    if len(items) == 1:
+        return items[0]
+    if torch.is_tensor(items[0]):
+        return torch.cat(items, dim=0)
+    return np.concatenate(items, axis=0)
+
+class InferRequest:
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.size = len(inputs[0])
+        self.future = Future()
+        self.time = time.perf_counter()
+
+class InferScheduler:
+    """
+    Process-wide batching of model forwards across sessions.
+
+    Every session inference thread submits its prepared batch with infer() and blocks until
+    the result is back, so each session keeps its own frame order. The worker thread
+    coalesces requests of different sessions into one forward call. A batch is dispatched
+    when every active session has submitted, when max_batch_size frames are collected, or
+    when the oldest request has waited max_wait seconds, whichever comes first. A session
+    is active while it submits batches, silent sessions that skip the model are not
+    waited for.
+    """
+    def __init__(self, forward_fn, max_batch_size, max_wait=0.01):
+        self.forward_fn = forward_fn # forward_fn(*inputs) -> outputs indexable along dim 0
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = Queue()
+        self._pending = None
+        self._sessions = set() #keys of the sessions currently submitting
+        self._lock = Lock()
+
+        self.count = 0
+        self.counttime = 0
+        self.countsessions = 0
+        self.countforward = 0
+        Thread(target=self.__run, daemon=True, name="infer_scheduler").start()
+
+    @property
+    def _active(self):
+        return len(self._sessions)
+
+    def set_active(self, session, active):
+        """mark a session (any hashable key) as submitting or idle"""
+        with self._lock:
+            if active:
+                self._sessions.add(session)
+            else:
+                self._sessions.discard(session)
+
+    def infer(self, *inputs):
+        """submit one session batch, inputs are tensors/arrays with the frames on dim 0"""
+        request = InferRequest(inputs)
+        self._queue.put(request)
+        return request.future.result()
+
+    def __next_request(self, timeout=None):
+        if self._pending is not None:
+            request = self._pending
+            self._pending = None
+            return request
+        return self._queue.get(block=True, timeout=timeout)
+
+    def __collect(self):
+        batch = [self.__next_request()]
+        size = batch[0].size
+        deadline = batch[0].time + self.max_wait
+        while size < self.max_batch_size and len(batch) < max(self._active, 1):
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.__next_request(timeout)
+            except queue.Empty:
+                break
+            if size + request.size > self.max_batch_size:
+                self._pending = request
+                break
+            batch.append(request)
+            size += request.size
+        return batch
+
+    @torch.no_grad()
+    def __forward(self, batch):
+        t = time.perf_counter()
+        try:
+            inputs = [_concat([request.inputs[k] for request in batch]) for k in range(len(batch[0].inputs))]
+            outputs = self.forward_fn(*inputs)
+        except Exception as e:
+            logger.exception('infer scheduler')
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        offset = 0
+        for request in batch:
+            request.future.set_result(outputs[offset:offset+request.size])
+            offset += request.size
+
+        self.counttime += (time.perf_counter() - t)
+        self.count += offset
+        self.countsessions += len(batch)
+        self.countforward += 1
+        if self.count >= 100*max(self._active, 1):
+            logger.info(f"------shared infer fps:{self.count/self.counttime:.4f}, avg sessions per forward:{self.countsessions/self.countforward:.2f}")
+            self.count = 0
+            self.counttime = 0
+            self.countsessions = 0
+            self.countforward = 0
+
+    def __run(self):
+        while True:
+            batch = self.__collect()
+            self.__forward(batch)
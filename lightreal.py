@@ -36,9 +36,10 @@ import torch.multiprocessing as mp
 from hubertasr import HubertASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from basereal import BaseReal
+from basereal import BaseReal,speech_frames,pad_to_bucket,select_frames,face_inputs_to_device
+from avatarpack import has_pack,load_pack
 
-#from imgcache import ImgCache
+from imgcache import ImgCache
 
 from tqdm import tqdm
 
@@ -63,7 +64,7 @@ def load_model(opt):
     audio_processor = Audio2Feature()
     return audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,cache_mb=0,face_inputs_mb=1024):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
@@ -71,28 +72,57 @@ def load_avatar(avatar_id):
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
     model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+
+    if has_pack(avatar_path):
+        pack = load_pack(avatar_path)
+        return model.eval(),pack['full_imgs'],pack['face_imgs'],pack['coords'],build_face_inputs(pack['face_imgs'],face_inputs_mb)
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
+    if cache_mb > 0: #decode lazily, keep at most cache_mb of each image list in memory
+        frame_list_cycle = ImgCache(input_img_list,cache_mb*1024**2)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    face_list_cycle = read_imgs(input_face_list)
-
-    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
+    if cache_mb > 0:
+        face_list_cycle = ImgCache(input_face_list,cache_mb*1024**2)
+    else:
+        face_list_cycle = read_imgs(input_face_list)
+
+    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle,build_face_inputs(face_list_cycle,face_inputs_mb)
+
+def build_face_inputs(face_list_cycle,max_mb=1024):
+    '''
+    visual input of every cycle index, [N,6,160,160] uint8 on device: face crop, then face crop with the mouth area masked.
+    a batch is one gather plus /255, kept as uint8 to use a quarter of the memory of float.
+    avatars above max_mb stay in host memory and upload each batch
+    '''
+    logger.info('building face inputs...')
+    face_inputs = np.empty((len(face_list_cycle),6,160,160),dtype=np.uint8)
+    for i in tqdm(range(len(face_list_cycle))):
+        img_real_ex = face_list_cycle[i][4:164, 4:164]
+        img_masked = cv2.rectangle(img_real_ex.copy(),(5,5,150,145),(0,0,0),-1)
+        face_inputs[i,:3] = img_real_ex.transpose(2,0,1)
+        face_inputs[i,3:] = img_masked.transpose(2,0,1)
+    return face_inputs_to_device(face_inputs,device,max_mb)
 
 
 @torch.no_grad()
 def warm_up(batch_size,avatar,modelres):
     logger.info('warmup model...')
-    model,_,_,_ = avatar
+    model,_,_,_,_ = avatar
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
 
+@torch.no_grad()
+def infer_batch(model,img_batch,mel_batch):
+    pred = model(img_batch.cuda(),mel_batch.cuda())
+    return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
 def read_imgs(img_list):
     frames = []
     logger.info('reading images...')
@@ -145,86 +175,80 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
-    length = len(face_list_cycle)
+def inference(quit_event, batch_size, face_input_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model, scheduler=None):
+    length = len(face_input_cycle)
     index = 0
     count = 0
     counttime = 0
     logger.info('start inference')
-
-    while not quit_event.is_set():
-        starttime=time.perf_counter()
-        try:
-            mel_batch = audio_feat_queue.get(block=True, timeout=1)
-        except queue.Empty:
-            continue
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type_,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type_,eventpoint))
-            if type_==0:
-                is_all_silence=False
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-        else:
-            t = time.perf_counter()
-            img_batch = []
-
-            for i in range(batch_size):
-                idx = __mirror_index(length, index + i)
-                #face = face_list_cycle[idx]
-                crop_img = face_list_cycle[idx] #face[ymin:ymax, xmin:xmax]
-#                h, w = crop_img.shape[:2]
-                #crop_img = cv2.resize(crop_img, (168, 168), cv2.INTER_AREA)
-                #crop_img_ori = crop_img.copy()
-                img_real_ex = crop_img[4:164, 4:164].copy()
-                img_real_ex_ori = img_real_ex.copy()
-                img_masked = cv2.rectangle(img_real_ex_ori,(5,5,150,145),(0,0,0),-1)
-    
-                img_masked = img_masked.transpose(2,0,1).astype(np.float32)
-                img_real_ex = img_real_ex.transpose(2,0,1).astype(np.float32)
-    
-                img_real_ex_T = torch.from_numpy(img_real_ex / 255.0)
-                img_masked_T = torch.from_numpy(img_masked / 255.0)
-                img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
-                img_batch.append(img_concat_T)
-
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
-            mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
-            img_batch = torch.stack(img_batch).squeeze(1)
-
-
-            with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-
-            counttime += (time.perf_counter() - t)
-            count += batch_size
-            if count >= 100:
-                logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
-                count = 0
-                counttime = 0
-            for i,res_frame in enumerate(pred):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-
-#            for i, pred_frame in enumerate(pred):
-#                pred_frame_uint8 = np.array(pred_frame, dtype=np.uint8)
-#                res_frame_queue.put((pred_frame_uint8, __mirror_index(length, index), audio_frames[i * 2:i * 2 + 2]))
-#                index = (index + 1) % length
-
-        #print('total batch time:', time.perf_counter() - starttime)
-
+    session = object() #key of this session in the scheduler
+    try:
+
+        while not quit_event.is_set():
+            starttime=time.perf_counter()
+            try:
+                mel_batch = audio_feat_queue.get(block=True, timeout=1)
+            except queue.Empty:
+                if scheduler is not None:
+                    scheduler.set_active(session, False)
+                continue
+            generation = audio_out_queue.generation #read before the frames, a later flush_talk makes them stale
+            audio_frames = []
+            for _ in range(batch_size*2):
+                frame,type_,eventpoint = audio_out_queue.get()
+                audio_frames.append((frame,type_,eventpoint))
+            speech = speech_frames(audio_frames, batch_size) #only these frames need the model
+            if len(speech)==0:
+                if scheduler is not None: #silent sessions are not waited for
+                    scheduler.set_active(session, False)
+                for i in range(batch_size):
+                    res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2],generation))
+                    index = index + 1
+            else:
+                t = time.perf_counter()
+                sel = pad_to_bucket(speech, batch_size)
+                idx = [__mirror_index(length, index + i) for i in sel]
+                img_batch = face_input_cycle[idx].to(device, non_blocking=True).float() / 255.0
+
+                mel_batch = select_frames(mel_batch, sel).view(-1, 32, 32, 32)
+
+
+                if scheduler is not None:
+                    scheduler.set_active(session, True)
+                    pred = scheduler.infer(img_batch, mel_batch)
+                else:
+                    pred = infer_batch(model, img_batch, mel_batch)
+
+                counttime += (time.perf_counter() - t)
+                count += len(sel)
+                if count >= 100:
+                    logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
+                    count = 0
+                    counttime = 0
+                res_frames = [None]*batch_size #silent frames keep their order with a None result
+                for k,i in enumerate(speech):
+                    res_frames[i] = pred[k]
+                for i,res_frame in enumerate(res_frames):
+                    #self.__pushmedia(res_frame,loop,audio_track,video_track)
+                    res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2],generation))
+                    index = index + 1
+
+    #            for i, pred_frame in enumerate(pred):
+    #                pred_frame_uint8 = np.array(pred_frame, dtype=np.uint8)
+    #                res_frame_queue.put((pred_frame_uint8, __mirror_index(length, index), audio_frames[i * 2:i * 2 + 2]))
+    #                index = (index + 1) % length
+
+            #print('total batch time:', time.perf_counter() - starttime)
+
+    finally:
+        if scheduler is not None:
+            scheduler.set_active(session, False)
     logger.info('lightreal inference processor stop')
 
 
 class LightReal(BaseReal):
     @torch.no_grad()
-    def __init__(self, opt, model, avatar):
+    def __init__(self, opt, model, avatar, scheduler=None):
         super().__init__(opt)
         #self.opt = opt # shared with the trainer's opt to support in-place modification of rendering parameters.
         # self.W = opt.W
@@ -237,7 +261,12 @@ class LightReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         audio_processor = model
-        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.scheduler = scheduler
+        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_input_cycle = avatar
+        if isinstance(self.frame_list_cycle,ImgCache): #own readahead direction per session
+            self.frame_list_cycle = self.frame_list_cycle.reader()
+        if isinstance(self.face_list_cycle,ImgCache):
+            self.face_list_cycle = self.face_list_cycle.reader()
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -266,12 +295,14 @@ class LightReal(BaseReal):
         #if self.opt.asr:
         #     self.asr.warm_up()
 
-        self.tts.render(quit_event)
+        tts_thread = self.tts.render(quit_event)
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+        infer_thread = Thread(target=inference, args=(quit_event,self.batch_size,self.face_input_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                           self.model,self.scheduler))  #mp.Process
+        infer_thread.start()
+        self.worker_threads = [tts_thread,process_thread,infer_thread]
         
 
         #self.render_event.set() #start infer process render
@@ -282,15 +313,14 @@ class LightReal(BaseReal):
         while not quit_event.is_set(): 
             # update texture every frame
             # audio stream thread...
+            if not self.credits.acquire(self.batch_size,timeout=1): #granted back as the output sends frames
+                continue
             t = time.perf_counter()
             self.asr.run_step()
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
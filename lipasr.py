@@ -27,6 +27,17 @@ from baseasr import BaseASR
 from wav2lip import audio
 
 class LipASR(BaseASR):
+    def __init__(self, opt, parent=None):
+        super().__init__(opt,parent)
+        self.mel_stream = None
+        if getattr(opt, 'mel_stream', False):
+            # keep a little more than one window of mel columns (1.6 columns per 20ms frame)
+            self.mel_stream = audio.MelStream(max_cols=(self.stride_left_size+self.stride_right_size+self.batch_size*2)*2)
+
+    def reset(self):
+        if self.mel_stream is not None:
+            self.mel_stream.reset()
+        super().reset()
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
@@ -39,6 +50,11 @@ class LipASR(BaseASR):
         # context not enough, do not run network.
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
+
+        if self.mel_stream is not None:
+            self.put_feat(self.__stream_mel_chunks())
+            self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+            return
         
         inputs = np.concatenate(self.frames) # [N * chunk]
         mel = audio.melspectrogram(inputs)
@@ -58,7 +74,24 @@ class LipASR(BaseASR):
             else:
                 mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
             i += 1
-        self.feat_queue.put(mel_chunks)
+        self.put_feat(mel_chunks)
         
         # discard the old part to save memory
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+
+    def __stream_mel_chunks(self):
+        # only the audio not yet seen by the mel stream is transformed
+        if self.mel_stream.num_samples == 0:
+            self.mel_stream.push(np.concatenate(self.frames))
+        else:
+            self.mel_stream.push(np.concatenate(self.frames[-self.batch_size*2:]))
+        # stream sample index of self.frames[0]
+        window_start = self.mel_stream.num_samples - len(self.frames)*self.chunk
+        hop_size = self.mel_stream.hop_size
+        mel_chunks = []
+        i = 0
+        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
+            start_idx = int((window_start + (self.stride_left_size + i*2)*self.chunk) / hop_size)
+            mel_chunks.append(self.mel_stream.get_chunk(start_idx, 16))
+            i += 1
+        return mel_chunks
@@ -37,9 +37,10 @@ from lipasr import LipASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
-from basereal import BaseReal
+from basereal import BaseReal,speech_frames,pad_to_bucket,select_frames,face_inputs_to_device
+from avatarpack import has_pack,load_pack
 
-#from imgcache import ImgCache
+from imgcache import ImgCache
 
 from tqdm import tqdm
 from logger import logger
@@ -68,23 +69,46 @@ def load_model(path):
 	model = model.to(device)
 	return model.eval()
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,cache_mb=0,face_inputs_mb=1024):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl"
+
+    if has_pack(avatar_path):
+        pack = load_pack(avatar_path)
+        return pack['full_imgs'],build_face_inputs(pack['face_imgs'],face_inputs_mb),pack['coords']
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
+    if cache_mb > 0: #decode lazily, keep at most cache_mb of each image list in memory
+        frame_list_cycle = ImgCache(input_img_list,cache_mb*1024**2)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    face_list_cycle = read_imgs(input_face_list)
+    face_input_cycle = build_face_inputs(read_imgs(input_face_list),face_inputs_mb)
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+    return frame_list_cycle,face_input_cycle,coord_list_cycle
+
+def build_face_inputs(face_list_cycle,max_mb=1024):
+    '''
+    visual input of every cycle index, [N,6,H,W] uint8 on device: face with the lower half masked, then face.
+    a batch is one gather plus /255, kept as uint8 to use a quarter of the memory of float.
+    avatars above max_mb stay in host memory and upload each batch
+    '''
+    logger.info('building face inputs...')
+    face_inputs = None
+    for i in tqdm(range(len(face_list_cycle))):
+        face = face_list_cycle[i].transpose(2,0,1)
+        if face_inputs is None:
+            face_inputs = np.empty((len(face_list_cycle),6)+face.shape[1:],dtype=np.uint8)
+        face_inputs[i,:3] = face
+        face_inputs[i,:3,face.shape[1]//2:] = 0
+        face_inputs[i,3:] = face
+    return face_inputs_to_device(face_inputs,device,max_mb)
 
 @torch.no_grad()
 def warm_up(batch_size,model,modelres):
@@ -94,6 +118,11 @@ def warm_up(batch_size,model,modelres):
     mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
     model(mel_batch, img_batch)
 
+@torch.no_grad()
+def infer_batch(model,mel_batch,img_batch):
+    pred = model(mel_batch, img_batch)
+    return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
 def read_imgs(img_list):
     frames = []
     logger.info('reading images...')
@@ -111,7 +140,7 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def inference(quit_event,batch_size,face_input_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model,scheduler=None):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -119,71 +148,73 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     # face_list_cycle = read_imgs(input_face_list)
     
     #input_latent_list_cycle = torch.load(latents_out_path)
-    length = len(face_list_cycle)
+    length = len(face_input_cycle)
     index = 0
     count=0
     counttime=0
     logger.info('start inference')
-    while not quit_event.is_set():
-        starttime=time.perf_counter()
-        mel_batch = []
-        try:
-            mel_batch = audio_feat_queue.get(block=True, timeout=1)
-        except queue.Empty:
-            continue
+    session = object() #key of this session in the scheduler
+    try:
+        while not quit_event.is_set():
+            starttime=time.perf_counter()
+            mel_batch = []
+            try:
+                mel_batch = audio_feat_queue.get(block=True, timeout=1)
+            except queue.Empty:
+                if scheduler is not None:
+                    scheduler.set_active(session, False)
+                continue
             
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
-
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-        else:
-            # print('infer=======')
-            t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+            generation = audio_out_queue.generation #read before the frames, a later flush_talk makes them stale
+            audio_frames = []
+            for _ in range(batch_size*2):
+                frame,type,eventpoint = audio_out_queue.get()
+                audio_frames.append((frame,type,eventpoint))
+            speech = speech_frames(audio_frames,batch_size) #only these frames need the model
 
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-            
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+            if len(speech)==0:
+                if scheduler is not None: #silent sessions are not waited for
+                    scheduler.set_active(session, False)
+                for i in range(batch_size):
+                    res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2],generation))
+                    index = index + 1
+            else:
+                # print('infer=======')
+                t=time.perf_counter()
+                sel = pad_to_bucket(speech,batch_size)
+                idx = [__mirror_index(length,index+i) for i in sel]
+                img_batch = face_input_cycle[idx].to(device, non_blocking=True).float() / 255.
+                mel_batch = select_frames(mel_batch, sel).unsqueeze(1).to(device, non_blocking=True) #[B,1,80,16]
 
-            with torch.no_grad():
-                pred = model(mel_batch, img_batch)
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+                if scheduler is not None:
+                    scheduler.set_active(session, True)
+                    pred = scheduler.infer(mel_batch, img_batch)
+                else:
+                    pred = infer_batch(model, mel_batch, img_batch)
 
-            counttime += (time.perf_counter() - t)
-            count += batch_size
-            #_totalframe += 1
-            if count>=100:
-                logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
-                count=0
-                counttime=0
-            for i,res_frame in enumerate(pred):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-            #print('total batch time:',time.perf_counter()-starttime)            
+                counttime += (time.perf_counter() - t)
+                count += len(sel)
+                #_totalframe += 1
+                if count>=100:
+                    logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
+                    count=0
+                    counttime=0
+                res_frames = [None]*batch_size #silent frames keep their order with a None result
+                for k,i in enumerate(speech):
+                    res_frames[i] = pred[k]
+                for i,res_frame in enumerate(res_frames):
+                    #self.__pushmedia(res_frame,loop,audio_track,video_track)
+                    res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2],generation))
+                    index = index + 1
+                #print('total batch time:',time.perf_counter()-starttime)            
+    finally:
+        if scheduler is not None:
+            scheduler.set_active(session, False)
     logger.info('lipreal inference processor stop')
 
 class LipReal(BaseReal):
     @torch.no_grad()
-    def __init__(self, opt, model, avatar):
+    def __init__(self, opt, model, avatar, scheduler=None):
         super().__init__(opt)
         #self.opt = opt # shared with the trainer's opt to support in-place modification of rendering parameters.
         # self.W = opt.W
@@ -196,7 +227,10 @@ class LipReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.scheduler = scheduler
+        self.frame_list_cycle,self.face_input_cycle,self.coord_list_cycle = avatar
+        if isinstance(self.frame_list_cycle,ImgCache): #own readahead direction per session
+            self.frame_list_cycle = self.frame_list_cycle.reader()
 
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
@@ -221,14 +255,16 @@ class LipReal(BaseReal):
         #if self.opt.asr:
         #     self.asr.warm_up()
 
-        self.tts.render(quit_event)
+        tts_thread = self.tts.render(quit_event)
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
+        infer_thread = Thread(target=inference, args=(quit_event,self.batch_size,self.face_input_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+                                           self.model,self.scheduler))  #mp.Process
+        infer_thread.start()
+        self.worker_threads = [tts_thread,process_thread,infer_thread]
 
         #self.render_event.set() #start infer process render
         count=0
@@ -238,15 +274,14 @@ class LipReal(BaseReal):
         while not quit_event.is_set(): 
             # update texture every frame
             # audio stream thread...
+            if not self.credits.acquire(self.batch_size,timeout=1): #granted back as the output sends frames
+                continue
             t = time.perf_counter()
             self.asr.run_step()
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
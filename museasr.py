@@ -22,12 +22,20 @@ import queue
 from queue import Queue
 #import multiprocessing as mp
 from baseasr import BaseASR
-from musetalk.whisper.audio2feature import Audio2Feature
+from musetalk.whisper.audio2feature import Audio2Feature,StreamingAudio2Feature
 
 class MuseASR(BaseASR):
     def __init__(self, opt, parent,audio_processor:Audio2Feature):
         super().__init__(opt,parent)
         self.audio_processor = audio_processor
+        self.stream_processor = None
+        if getattr(opt, 'whisper_stream', False):
+            self.stream_processor = StreamingAudio2Feature(audio_processor)
+
+    def reset(self):
+        if self.stream_processor is not None:
+            self.stream_processor.reset()
+        super().reset()
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
@@ -41,13 +49,16 @@ class MuseASR(BaseASR):
             return
         
         inputs = np.concatenate(self.frames) # [N * chunk]
-        whisper_feature = self.audio_processor.audio2feat(inputs)
+        if self.stream_processor is not None:
+            whisper_feature = self.stream_processor.audio2feat(inputs,self.batch_size*2*self.chunk)
+        else:
+            whisper_feature = self.audio_processor.audio2feat(inputs)
         # for feature in whisper_feature:
         #     self.audio_feats.append(feature)        
         #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
         whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=self.batch_size,start=self.stride_left_size/2 )
         #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
         #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
-        self.feat_queue.put(whisper_chunks)
+        self.put_feat(whisper_chunks)
         # discard the old part to save memory
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
@@ -36,14 +36,16 @@ import torch.multiprocessing as mp
 
 from musetalk.utils.utils import get_file_type,get_video_fps,datagen
 #from musetalk.utils.preprocessing import get_landmark_and_bbox,read_imgs,coord_placeholder
-from musetalk.myutil import get_image_blending
+from musetalk.myutil import get_blend_material,blend_face_roi
 from musetalk.utils.utils import load_all_model
 from musetalk.whisper.audio2feature import Audio2Feature
 
 from museasr import MuseASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from basereal import BaseReal
+from basereal import BaseReal,speech_frames,pad_to_bucket,select_frames
+from avatarpack import has_pack,load_pack
+from imgcache import ImgCache
 
 from tqdm import tqdm
 from logger import logger
@@ -62,7 +64,7 @@ def load_model():
     audio_processor = Audio2Feature(model_path="./models/whisper/tiny.pt")
     return vae, unet, pe, timesteps, audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,cache_mb=0):
     #self.video_path = '' #video_path
     #self.bbox_shift = opt.bbox_shift
     avatar_path = f"./data/avatars/{avatar_id}"
@@ -79,18 +81,45 @@ def load_avatar(avatar_id):
     #     "bbox_shift":self.bbox_shift   
     # }
 
+    if has_pack(avatar_path):
+        pack = load_pack(avatar_path)
+        device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
+        input_latent_list_cycle = list(torch.from_numpy(pack['latents']).to(device))
+        blend_mask_list_cycle,blend_box_list_cycle = prepare_blend_masks(pack['mask'],pack['coords'],pack['mask_coords'])
+        return pack['full_imgs'],blend_mask_list_cycle,pack['coords'],blend_box_list_cycle,input_latent_list_cycle
+
     input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    if cache_mb > 0: #decode lazily, keep at most cache_mb of each image list in memory
+        frame_list_cycle = ImgCache(input_img_list,cache_mb*1024**2)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     with open(mask_coords_path, 'rb') as f:
         mask_coords_list_cycle = pickle.load(f)
     input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
     input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    mask_list_cycle = read_imgs(input_mask_list)
-    return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
+    blend_mask_list_cycle,blend_box_list_cycle = prepare_blend_masks(input_mask_list,coord_list_cycle,mask_coords_list_cycle)
+    return frame_list_cycle,blend_mask_list_cycle,coord_list_cycle,blend_box_list_cycle,input_latent_list_cycle
+
+def prepare_blend_masks(mask_list,coord_list,mask_coords_list):
+    '''
+    mask_list: image paths or decoded masks.
+    keep only the float32 face box alpha of every mask, smaller than the bgr mask of the crop box
+    '''
+    blend_mask_list = []
+    blend_box_list = []
+    logger.info('preparing blend masks...')
+    for i in tqdm(range(len(mask_list))):
+        mask = mask_list[i]
+        if isinstance(mask,str):
+            mask = cv2.imread(mask)
+        alpha,blend_box = get_blend_material(mask,coord_list[i],mask_coords_list[i])
+        blend_mask_list.append(alpha)
+        blend_box_list.append(blend_box)
+    return blend_mask_list,blend_box_list
 
 @torch.no_grad()
 def warm_up(batch_size,model):
@@ -111,6 +140,18 @@ def warm_up(batch_size,model):
                               encoder_hidden_states=audio_feature_batch).sample
     vae.decode_latents(pred_latents)
 
+@torch.no_grad()
+def infer_batch(vae, unet, pe, timesteps, whisper_batch, latent_batch):
+    audio_feature_batch = whisper_batch.to(device=unet.device,
+                                                    dtype=unet.model.dtype, non_blocking=True)
+    audio_feature_batch = pe(audio_feature_batch)
+    latent_batch = latent_batch.to(dtype=unet.model.dtype)
+
+    pred_latents = unet.model(latent_batch, 
+                                timesteps, 
+                                encoder_hidden_states=audio_feature_batch).sample
+    return vae.decode_latents(pred_latents)
+
 def read_imgs(img_list):
     frames = []
     logger.info('reading images...')
@@ -130,7 +171,7 @@ def __mirror_index(size, index):
 
 @torch.no_grad()
 def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,
-              vae, unet, pe,timesteps): #vae, unet, pe,timesteps
+              vae, unet, pe,timesteps,scheduler=None): #vae, unet, pe,timesteps
     
     # vae, unet, pe = load_diffusion_model()
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -144,73 +185,76 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
     count=0
     counttime=0
     logger.info('start inference')
-    while render_event.is_set():
-        starttime=time.perf_counter()
-        try:
-            whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
-        except queue.Empty:
-            continue
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-        else:
-            # print('infer=======')
-            t=time.perf_counter()
-            whisper_batch = np.stack(whisper_chunks)
-            latent_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                latent = input_latent_list_cycle[idx]
-                latent_batch.append(latent)
-            latent_batch = torch.cat(latent_batch, dim=0)
+    session = object() #key of this session in the scheduler
+    try:
+        while render_event.is_set():
+            starttime=time.perf_counter()
+            try:
+                whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
+            except queue.Empty:
+                if scheduler is not None:
+                    scheduler.set_active(session, False)
+                continue
+            generation = audio_out_queue.generation #read before the frames, a later flush_talk makes them stale
+            audio_frames = []
+            for _ in range(batch_size*2):
+                frame,type,eventpoint = audio_out_queue.get()
+                audio_frames.append((frame,type,eventpoint))
+            speech = speech_frames(audio_frames,batch_size) #only these frames need the model
+            if len(speech)==0:
+                if scheduler is not None: #silent sessions are not waited for
+                    scheduler.set_active(session, False)
+                for i in range(batch_size):
+                    res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2],generation))
+                    index = index + 1
+            else:
+                # print('infer=======')
+                t=time.perf_counter()
+                sel = pad_to_bucket(speech,batch_size)
+                whisper_batch = select_frames(whisper_chunks,sel)
+                latent_batch = []
+                for i in sel:
+                    idx = __mirror_index(length,index+i)
+                    latent = input_latent_list_cycle[idx]
+                    latent_batch.append(latent)
+                latent_batch = torch.cat(latent_batch, dim=0)
             
-            # for i, (whisper_batch,latent_batch) in enumerate(gen):
-            audio_feature_batch = torch.from_numpy(whisper_batch)
-            audio_feature_batch = audio_feature_batch.to(device=unet.device,
-                                                            dtype=unet.model.dtype)
-            audio_feature_batch = pe(audio_feature_batch)
-            latent_batch = latent_batch.to(dtype=unet.model.dtype)
-            # print('prepare time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-
-            pred_latents = unet.model(latent_batch, 
-                                        timesteps, 
-                                        encoder_hidden_states=audio_feature_batch).sample
-            # print('unet time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-            recon = vae.decode_latents(pred_latents)
-            # infer_inqueue.put((whisper_batch,latent_batch,sessionid))
-            # recon,outsessionid = infer_outqueue.get()
-            # if outsessionid != sessionid:
-            #     print('outsessionid:',outsessionid,' mysessionid:',sessionid)
-
-            # print('vae time:',time.perf_counter()-t)
-            #print('diffusion len=',len(recon))
-            counttime += (time.perf_counter() - t)
-            count += batch_size
-            #_totalframe += 1
-            if count>=100:
-                logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
-                count=0
-                counttime=0
-            for i,res_frame in enumerate(recon):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-            #print('total batch time:',time.perf_counter()-starttime)            
+                # for i, (whisper_batch,latent_batch) in enumerate(gen):
+                if scheduler is not None:
+                    scheduler.set_active(session, True)
+                    recon = scheduler.infer(whisper_batch, latent_batch)
+                else:
+                    recon = infer_batch(vae, unet, pe, timesteps, whisper_batch, latent_batch)
+                # infer_inqueue.put((whisper_batch,latent_batch,sessionid))
+                # recon,outsessionid = infer_outqueue.get()
+                # if outsessionid != sessionid:
+                #     print('outsessionid:',outsessionid,' mysessionid:',sessionid)
+
+                # print('vae time:',time.perf_counter()-t)
+                #print('diffusion len=',len(recon))
+                counttime += (time.perf_counter() - t)
+                count += len(sel)
+                #_totalframe += 1
+                if count>=100:
+                    logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
+                    count=0
+                    counttime=0
+                res_frames = [None]*batch_size #silent frames keep their order with a None result
+                for k,i in enumerate(speech):
+                    res_frames[i] = recon[k]
+                for i,res_frame in enumerate(res_frames):
+                    #self.__pushmedia(res_frame,loop,audio_track,video_track)
+                    res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2],generation))
+                    index = index + 1
+                #print('total batch time:',time.perf_counter()-starttime)            
+    finally:
+        if scheduler is not None:
+            scheduler.set_active(session, False)
     logger.info('musereal inference processor stop')
 
 class MuseReal(BaseReal):
     @torch.no_grad()
-    def __init__(self, opt, model, avatar):
+    def __init__(self, opt, model, avatar, scheduler=None):
         super().__init__(opt)
         #self.opt = opt # shared with the trainer's opt to support in-place modification of rendering parameters.
         # self.W = opt.W
@@ -223,7 +267,11 @@ class MuseReal(BaseReal):
         self.res_frame_queue = mp.Queue(self.batch_size*2)
 
         self.vae, self.unet, self.pe, self.timesteps, self.audio_processor = model
-        self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
+        self.scheduler = scheduler
+        self.frame_list_cycle,self.blend_mask_list_cycle,self.coord_list_cycle,self.blend_box_list_cycle, self.input_latent_list_cycle = avatar
+        if isinstance(self.frame_list_cycle,ImgCache): #own readahead direction per session
+            self.frame_list_cycle = self.frame_list_cycle.reader()
+        self.combine_frame = None #reused output buffer of paste_back_frame
         #self.__loadavatar()
 
         self.asr = MuseASR(opt,self,self.audio_processor)
@@ -246,8 +294,7 @@ class MuseReal(BaseReal):
 
     def __warm_up(self): 
         self.asr.run_step()
-        whisper_chunks = self.asr.get_next_feat()
-        whisper_batch = np.stack(whisper_chunks)
+        whisper_batch = self.asr.get_next_feat()
         latent_batch = []
         for i in range(self.batch_size):
             idx = self.__mirror_index(self.idx+i)
@@ -256,8 +303,7 @@ class MuseReal(BaseReal):
         latent_batch = torch.cat(latent_batch, dim=0)
         logger.info('infer=======')
         # for i, (whisper_batch,latent_batch) in enumerate(gen):
-        audio_feature_batch = torch.from_numpy(whisper_batch)
-        audio_feature_batch = audio_feature_batch.to(device=self.unet.device,
+        audio_feature_batch = whisper_batch.to(device=self.unet.device,
                                                         dtype=self.unet.model.dtype)
         audio_feature_batch = self.pe(audio_feature_batch)
         latent_batch = latent_batch.to(dtype=self.unet.model.dtype)
@@ -270,29 +316,32 @@ class MuseReal(BaseReal):
 
     def paste_back_frame(self,pred_frame,idx:int):
         bbox = self.coord_list_cycle[idx]
-        ori_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        ori_frame = self.frame_list_cycle[idx]
         x1, y1, x2, y2 = bbox
 
         res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
-        mask = self.mask_list_cycle[idx]
-        mask_crop_box = self.mask_coords_list_cycle[idx]
+        # the returned frame is consumed by process_frames before the next call, so one buffer per session is enough
+        if self.combine_frame is None or self.combine_frame.shape != ori_frame.shape:
+            self.combine_frame = np.empty_like(ori_frame)
+        np.copyto(self.combine_frame,ori_frame)
 
-        combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
-        return combine_frame
+        return blend_face_roi(self.combine_frame,res_frame,bbox,self.blend_mask_list_cycle[idx],self.blend_box_list_cycle[idx])
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
         #if self.opt.asr:
         #     self.asr.warm_up()
 
-        self.tts.render(quit_event)
+        tts_thread = self.tts.render(quit_event)
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
         self.render_event.set() #start infer process render
-        Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
+        infer_thread = Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.vae, self.unet, self.pe,self.timesteps)).start() #mp.Process
+                                           self.vae, self.unet, self.pe,self.timesteps,self.scheduler)) #mp.Process
+        infer_thread.start()
+        self.worker_threads = [tts_thread,process_thread,infer_thread]
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -300,6 +349,8 @@ class MuseReal(BaseReal):
         while not quit_event.is_set(): #todo
             # update texture every frame
             # audio stream thread...
+            if not self.credits.acquire(self.batch_size,timeout=1): #granted back as the output sends frames
+                continue
             t = time.perf_counter()
             self.asr.run_step()
             #self.test_step(loop,audio_track,video_track)
@@ -309,9 +360,6 @@ class MuseReal(BaseReal):
             #     print(f"------actual avg infer fps:{count/totaltime:.4f}")
             #     count=0
             #     totaltime=0
-            if video_track and video_track._queue.qsize()>=1.5*self.opt.batch_size:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
             # if video_track._queue.qsize()>=5:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
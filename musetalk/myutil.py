@@ -24,4 +24,55 @@ def get_image_blending(image,face,face_box,mask_array,crop_box):
     body[y_s:y_e, x_s:x_e] = cv2.blendLinear(face_large,body[y_s:y_e, x_s:x_e],mask_image,1-mask_image)
 
     #body.paste(face_large, crop_box[:2], mask_image)
-    return body
\ No newline at end of file
+    return body
+
+def get_blend_material(mask_array,face_box,crop_box):
+    """
+    precompute the per avatar frame part of get_image_blending.
+    return the single channel float32 alpha of the blend region and the region (x,y,x1,y1) in the full frame.
+    outside the face box face_large equals the background, so only the face box needs blending
+    """
+    x, y, x1, y1 = face_box
+    x_s, y_s, x_e, y_e = crop_box
+    blend_box = (max(x,x_s), max(y,y_s), min(x1,x_e), min(y1,y_e))
+    bx, by, bx1, by1 = blend_box
+    if mask_array.ndim == 3:
+        mask_array = cv2.cvtColor(mask_array,cv2.COLOR_BGR2GRAY)
+    alpha = (mask_array[by-y_s:by1-y_s, bx-x_s:bx1-x_s]/255).astype(np.float32)
+    return alpha,blend_box
+
+def blend_face_roi(out,face,face_box,alpha,blend_box):
+    """blend face (resized to face_box) into out in place, only inside blend_box. same result as get_image_blending"""
+    x, y, x1, y1 = face_box
+    bx, by, bx1, by1 = blend_box
+    roi = out[by:by1, bx:bx1]
+    roi[:] = cv2.blendLinear(face[by-y:by1-y, bx-x:bx1-x],roi,alpha,1-alpha)
+    return out
+
+
+if __name__ == '__main__':
+    # compare per frame compositing cost at 1080p: python -m musetalk.myutil
+    import time
+    body = np.random.randint(0,255,(1080,1920,3),dtype=np.uint8)
+    face_box = (800,300,1100,600)
+    crop_box = (725,225,1175,675)
+    face = np.random.randint(0,255,(300,300,3),dtype=np.uint8)
+    mask = cv2.GaussianBlur(np.random.randint(0,255,(450,450,3),dtype=np.uint8),(21,21),0)
+
+    ref = get_image_blending(copy.deepcopy(body),face,face_box,mask,crop_box)
+    alpha,blend_box = get_blend_material(mask,face_box,crop_box)
+    out = np.empty_like(body)
+    np.copyto(out,body)
+    blend_face_roi(out,face,face_box,alpha,blend_box)
+    print(f'max abs diff: {np.abs(ref.astype(np.int16)-out.astype(np.int16)).max()}')
+
+    n = 200
+    t = time.perf_counter()
+    for _ in range(n):
+        get_image_blending(copy.deepcopy(body),face,face_box,mask,crop_box)
+    print(f'deepcopy + get_image_blending: {(time.perf_counter()-t)/n*1000:.3f}ms')
+    t = time.perf_counter()
+    for _ in range(n):
+        np.copyto(out,body)
+        blend_face_roi(out,face,face_box,alpha,blend_box)
+    print(f'copyto + blend_face_roi: {(time.perf_counter()-t)/n*1000:.3f}ms')
@@ -1,7 +1,10 @@
 import os
 from .whisper import load_model
+from .whisper.audio import N_FFT, HOP_LENGTH, mel_filters
 import soundfile as sf
 import numpy as np
+import torch
+import torch.nn.functional as F
 import time
 import sys
 sys.path.append("..")
@@ -111,7 +114,120 @@ class Audio2Feature():
         concatenated_array = np.concatenate(embed_list, axis=0)
         return concatenated_array
 
+    @torch.no_grad()
+    def encode_mel(self, log_spec):
+        """
+        Run the whisper encoder on an unpadded log-mel window
+        :param log_spec: torch.Tensor [80, 2*T], 2*T <= 3000
+        :return: np.ndarray [T, n_layer+1, 384], same layout as audio2feat
+        """
+        encoder = self.model.encoder
+        device = self.model.device
+        dtype = torch.float16 if device.type == 'cuda' else torch.float32
+        x = log_spec.unsqueeze(0).to(device=device, dtype=dtype)
+        x = F.gelu(encoder.conv1(x))
+        x = F.gelu(encoder.conv2(x))
+        x = x.permute(0, 2, 1)
+        x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+
+        embeddings = [x]
+        for block in encoder.blocks:
+            x = block(x)
+            embeddings.append(x)
+        embeddings = torch.stack(embeddings, dim=2)[0] # [T, n_layer+1, 384]
+        return embeddings.float().cpu().numpy()
+
+
+class StreamingAudio2Feature():
+    """
+    Per-session streaming front end for Audio2Feature.
+
+    audio2feat pads every window to a 30s mel segment before the encoder runs.
+    Here only the real window (left context + new audio + right context) is encoded,
+    and the STFT power columns of the part shared with the previous window are reused,
+    so each step only transforms the newly arrived samples.
+    """
+    def __init__(self, audio_processor:Audio2Feature, max_frames=1500):
+        self.audio_processor = audio_processor
+        self.max_frames = max_frames # encoder tokens (20ms) kept as left context at most
+        self.window = torch.hann_window(N_FFT)
+        self.filters = mel_filters('cpu')
+        self.reset()
+
+    def reset(self):
+        self.power = None # [201, 2*T] stft power of the last window
+        self.num_samples = 0
+
+    def audio2feat(self, audio, new_samples=None):
+        """
+        :param audio: np.ndarray 16k pcm of the whole window, length multiple of 320
+        :param new_samples: number of samples at the end of audio that were not in the previous window
+        :return: np.ndarray [T, n_layer+1, 384], T = len(audio)//320
+        """
+        max_samples = self.max_frames * HOP_LENGTH * 2
+        if len(audio) > max_samples:
+            audio = audio[-max_samples:]
+            self.reset()
+        num_cols = len(audio) // HOP_LENGTH
+        padded = torch.from_numpy(np.pad(audio.astype(np.float32), N_FFT // 2, mode='reflect'))
+
+        reuse = 0
+        if self.power is not None and new_samples is not None and len(audio) == self.num_samples \
+                and new_samples % HOP_LENGTH == 0 and new_samples < len(audio):
+            # the last column of the previous window was computed on reflect padding
+            reuse = num_cols - new_samples // HOP_LENGTH - 1
+        if reuse > 0:
+            shift = new_samples // HOP_LENGTH
+            start = reuse * HOP_LENGTH
+            stft = torch.stft(padded[start:], N_FFT, HOP_LENGTH, window=self.window, center=False, return_complex=True)
+            power = torch.cat([self.power[:, shift:shift+reuse], stft[:, :-1].abs() ** 2], dim=1)
+        else:
+            stft = torch.stft(padded, N_FFT, HOP_LENGTH, window=self.window, center=False, return_complex=True)
+            power = stft[:, :-1].abs() ** 2
+        self.power = power
+        self.num_samples = len(audio)
+
+        mel_spec = self.filters @ power
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return self.audio_processor.encode_mel(log_spec)
+
+
+def benchmark_streaming(audio_processor, batch_size=16, stride_left=10, stride_right=10, steps=50):
+    """compare audio2feat with StreamingAudio2Feature on synthetic audio, report chunk diff and ms per run_step"""
+    chunk = 320
+    rng = np.random.default_rng(0)
+    total_frames = stride_left + stride_right + batch_size*2*steps
+    t = np.arange(total_frames*chunk) / 16000.
+    signal = (0.3*np.sin(2*np.pi*220*t)*(1+np.sin(2*np.pi*3*t)) + 0.05*rng.standard_normal(len(t))).astype(np.float32)
+    streamer = StreamingAudio2Feature(audio_processor)
+    window = (stride_left + stride_right + batch_size*2) * chunk
+    new_samples = batch_size*2*chunk
+    cost_full = cost_stream = 0.
+    max_diff = 0.
+    for step in range(steps):
+        inputs = signal[step*new_samples:step*new_samples+window]
+        t0 = time.perf_counter()
+        feat = audio_processor.audio2feat(inputs)
+        chunks = audio_processor.feature2chunks(feature_array=feat,fps=25,batch_size=batch_size,start=stride_left/2)
+        t1 = time.perf_counter()
+        feat = streamer.audio2feat(inputs, new_samples)
+        stream_chunks = audio_processor.feature2chunks(feature_array=feat,fps=25,batch_size=batch_size,start=stride_left/2)
+        t2 = time.perf_counter()
+        cost_full += t1 - t0
+        cost_stream += t2 - t1
+        for a, b in zip(chunks, stream_chunks):
+            assert a.shape == b.shape == (50, 384)
+            max_diff = max(max_diff, float(np.abs(a - b).max() / (np.abs(a).max() + 1e-6)))
+    print(f"padded:    {cost_full/steps*1000:.2f} ms/run_step")
+    print(f"streaming: {cost_stream/steps*1000:.2f} ms/run_step")
+    print(f"max relative chunk diff: {max_diff:.4f}")
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'stream': #from the repo root: python -m musetalk.whisper.audio2feature stream
+        benchmark_streaming(Audio2Feature()) #same model as musereal
+        sys.exit(0)
     audio_processor = Audio2Feature(model_path="../../models/whisper/whisper_tiny.pt")
     audio_path = "./test.mp3"
     array = audio_processor.audio2feat(audio_path)
@@ -0,0 +1,135 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+
+# Benchmarks of the tts plumbing in ttsreal.py, no tts service needed:
+#   python ttsbench.py          streaming resampler vs resampy per chunk
+#   python ttsbench.py http     time to first chunk, new connection vs pooled session
+#   python ttsbench.py doubao   time to first chunk, websocket per sentence vs pooled connection
+
+import sys
+import time
+import asyncio
+from threading import Thread
+
+import numpy as np
+import resampy
+import requests
+import websockets
+
+from ttsreal import StreamResampler, get_http_session, DoubaoConnectionPool, _doubao_request
+
+def benchmark_resampler(sr_orig=44100, seconds=60, chunk_bytes=17640):
+    '''streaming resampler vs resampy.resample on every chunk, python ttsbench.py'''
+    x = (0.5 * np.sin(2 * np.pi * 440 * np.arange(sr_orig * seconds) / sr_orig)).astype(np.float32)
+    chunk = chunk_bytes // 2
+    ref = resampy.resample(x, sr_orig, 16000)
+
+    t = time.perf_counter()
+    out = [resampy.resample(x[i:i + chunk], sr_orig, 16000) for i in range(0, len(x), chunk)]
+    t_resampy = time.perf_counter() - t
+    err_resampy = np.abs(np.concatenate(out)[:len(ref)] - ref[:sum(len(o) for o in out)]).max()
+
+    t = time.perf_counter()
+    resampler = StreamResampler(sr_orig, 16000)
+    out = [resampler.process(x[i:i + chunk]) for i in range(0, len(x), chunk)]
+    out.append(resampler.flush())
+    t_stream = time.perf_counter() - t
+    out = np.concatenate(out)
+    err_stream = np.abs(out[:len(ref)] - ref[:len(out)]).max()
+
+    print(f'{seconds}s of {sr_orig}Hz in {chunk} sample chunks')
+    print(f'resampy per chunk: {t_resampy*1000:.1f}ms, max diff to whole-signal resampy {err_resampy:.5f}')
+    print(f'StreamResampler  : {t_stream*1000:.1f}ms, max diff to whole-signal resampy {err_stream:.5f}')
+
+def benchmark_http(sentences=50, chunks=20, chunk_bytes=9600):
+    '''per sentence time to first chunk against a local stand-in tts server, python ttsbench.py http'''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' #keep-alive
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(chunks*chunk_bytes))
+            self.end_headers()
+            pcm = bytes(chunk_bytes)
+            for _ in range(chunks):
+                self.wfile.write(pcm)
+                self.wfile.flush()
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/tts'
+
+    def run(post):
+        ttfc = []
+        for i in range(sentences):
+            start = time.perf_counter()
+            res = post(url, json={'text': f'sentence {i}'}, stream=True)
+            for n, chunk in enumerate(res.iter_content(chunk_size=chunk_bytes)):
+                if n == 0:
+                    ttfc.append(time.perf_counter() - start)
+        return np.array(ttfc) * 1000
+
+    for name, post in [('requests.post', requests.post), ('pooled session', get_http_session().post)]:
+        ttfc = run(post)
+        print(f'{name:15s} time to first chunk mean {ttfc.mean():.2f}ms p50 {np.median(ttfc):.2f}ms max {ttfc.max():.2f}ms')
+    server.shutdown()
+
+def benchmark_doubao(sentences=30, frames=20, frame_bytes=6400):
+    '''per sentence time to first chunk against a local fake doubao server, python ttsbench.py doubao'''
+    async def handler(ws, path=None):
+        pcm = bytes(frame_bytes)
+        async for request in ws:
+            await ws.send(b'\x11\xb0\x00\x00') #ack
+            for seq in range(1, frames+1):
+                if seq == frames:
+                    seq = -seq
+                await ws.send(b'\x11\xb1\x00\x00' + seq.to_bytes(4, 'big', signed=True) + len(pcm).to_bytes(4, 'big') + pcm)
+
+    async def run(pool):
+        ttfc = []
+        for i in range(sentences):
+            start = time.perf_counter()
+            first = True
+            async for payload in _doubao_request(pool, b'\x11\x10\x10\x00' + bytes(4)):
+                if first:
+                    ttfc.append(time.perf_counter() - start)
+                    first = False
+        return np.array(ttfc) * 1000
+
+    async def main():
+        server = await websockets.serve(handler, '127.0.0.1', 0)
+        url = f'ws://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+        for name, pool in [('connect per sentence', DoubaoConnectionPool(url, {}, max_idle=0)),
+                           ('pooled connection', DoubaoConnectionPool(url, {}))]:
+            ttfc = await run(pool)
+            print(f'{name:20s} time to first chunk mean {ttfc.mean():.2f}ms p50 {np.median(ttfc):.2f}ms max {ttfc.max():.2f}ms')
+        server.close()
+    asyncio.run(main())
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'http':
+        benchmark_http()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'doubao':
+        benchmark_doubao()
+    else:
+        benchmark_resampler()
@@ -0,0 +1,118 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import re
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import logger
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesized 16khz float32 pcm, shared by all sessions.
+
+    The key is a hash of (engine, voice, speed, volume, pitch, normalized text). Entries live
+    in a byte-budgeted LRU in memory; with cache_dir every entry is also written to disk as
+    raw float32 and memory-mapped back after it has been evicted from memory. Disk writes
+    run on a writer thread, off the tts threads.
+    """
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.writer = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tts_cache')
+        self.cache = OrderedDict() # key:pcm, most recently used last
+        self.nbytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    @staticmethod
+    def key(engine, opt, text):
+        text = re.sub(r'\s+', ' ', text).strip()
+        params = (engine, opt.TTS_SERVER, opt.REF_FILE, opt.REF_TEXT, getattr(opt, 'tts_speed', 1.0),
+                  getattr(opt, 'tts_volume', 1.0), getattr(opt, 'tts_pitch', 1.0), text)
+        return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.f32')
+
+    def get(self, key):
+        with self.lock:
+            stream = self.cache.get(key)
+            if stream is not None:
+                self.cache.move_to_end(key)
+        if stream is None and self.cache_dir and os.path.exists(self.__path(key)):
+            stream = np.memmap(self.__path(key), dtype=np.float32, mode='r')
+            self.__insert(key, stream)
+        with self.lock:
+            if stream is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if (self.hits + self.misses) % 50 == 0:
+                logger.info(f'tts cache {len(self.cache)} entries {self.nbytes/1024**2:.1f}MB hit rate:{self.hit_rate:.4f}')
+        return stream
+
+    def put(self, key, stream):
+        stream = np.ascontiguousarray(stream, dtype=np.float32)
+        self.__insert(key, stream)
+        if self.writer is not None:
+            self.writer.submit(self.__write, key, stream)
+
+    def __write(self, key, stream):
+        try:
+            tmp_path = self.__path(key) + '.tmp'
+            stream.tofile(tmp_path)
+            os.replace(tmp_path, self.__path(key))
+        except OSError:
+            logger.exception('tts cache write')
+
+    def __insert(self, key, stream):
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = stream
+            self.nbytes += stream.nbytes
+            while self.nbytes > self.max_bytes and len(self.cache) > 0:
+                _, old = self.cache.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+_tts_cache = None
+_tts_cache_lock = Lock()
+
+def get_tts_cache(opt):
+    """process wide cache, None when --tts_cache_mb is 0"""
+    global _tts_cache
+    max_mb = getattr(opt, 'tts_cache_mb', 0)
+    if max_mb <= 0:
+        return None
+    with _tts_cache_lock:
+        if _tts_cache is None:
+            _tts_cache = TTSCache(max_mb*1024**2, getattr(opt, 'tts_cache_dir', None))
+        return _tts_cache
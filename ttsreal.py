@@ -5,6 +5,7 @@ import soundfile as sf
 import resampy
 import asyncio
 import edge_tts
+import av
 
 import os
 import hmac
@@ -16,13 +17,15 @@ import uuid
 from typing import Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import queue
 from queue import Queue
 from io import BytesIO
 import copy,websockets,gzip
 
-from threading import Thread, Event
+from threading import Thread, Event, Lock, local
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from typing import TYPE_CHECKING
@@ -30,10 +33,122 @@ if TYPE_CHECKING:
     from basereal import BaseReal
 
 from logger import logger
+from ttscache import TTSCache,get_tts_cache
+
+_http_session = None
+_http_session_lock = Lock()
+
+def get_http_session(pool_size=10):
+    '''
+    process wide requests.Session for the http tts backends. Connections to the tts server
+    are kept alive and reused by every sentence of every session instead of a new tcp (and
+    tls) handshake per request; pool_size is the number of idle connections kept per host.
+    '''
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+_prompt_cache = {} #path -> (mtime,bytes)
+
+def _read_prompt(path):
+    '''reference audio uploaded with every request, read once and kept in memory'''
+    mtime = os.path.getmtime(path)
+    cached = _prompt_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, f.read())
+        _prompt_cache[path] = cached
+    return cached[1]
+
+_resample_filters = {} #(sr_orig,sr_new) -> (up,down,half_taps,filters)
+
+def _get_resample_filters(sr_orig, sr_new, num_zeros=16, rolloff=0.945, beta=8.6):
+    '''
+    polyphase kaiser windowed sinc for sr_orig -> sr_new, computed once per ratio.
+    filters[p] are the taps applied to input samples k-half_taps+1..k+half_taps for an
+    output at input time k+p/up
+    '''
+    key = (sr_orig, sr_new)
+    if key not in _resample_filters:
+        g = np.gcd(sr_orig, sr_new)
+        up, down = sr_new // g, sr_orig // g
+        fc = 0.5 * rolloff * min(1., up / down) #cutoff in cycles per input sample
+        half_len = num_zeros / (2 * fc)
+        half_taps = int(np.ceil(half_len))
+        offsets = np.arange(-half_taps + 1, half_taps + 1)
+        d = offsets[None, :] - np.arange(up)[:, None] / up #[up, 2*half_taps] distance in input samples
+        window = np.i0(beta * np.sqrt(np.clip(1 - (d / half_len) ** 2, 0, None))) / np.i0(beta)
+        filters = 2 * fc * np.sinc(2 * fc * d) * window
+        filters /= filters.sum(axis=1, keepdims=True) #unit dc gain for every phase
+        _resample_filters[key] = (up, down, half_taps, filters.astype(np.float32))
+    return _resample_filters[key]
+
+class StreamResampler:
+    """
+    Streaming polyphase resampler for the audio chunks of a tts response.
+
+    Unlike calling resampy.resample on every chunk, the input history is kept between chunks
+    so there are no edge artifacts, and the filters are shared by all streams with the same
+    ratio. Create one per utterance, process() every chunk and flush() at the end
+    (BaseTTS.put_stream_tail).
+    """
+    def __init__(self, sr_orig, sr_new=16000):
+        self.sr_orig = sr_orig
+        self.up, self.down, self.half_taps, self.filters = _get_resample_filters(sr_orig, sr_new)
+        self.offsets = np.arange(-self.half_taps + 1, self.half_taps + 1)
+        self.buffer = np.zeros(self.half_taps, dtype=np.float32) #zero history before the stream
+        self.base = -self.half_taps #absolute input index of buffer[0]
+        self.n = 0 #next output index
+        self.num_input = 0
+
+    def process(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        self.num_input += len(x)
+        self.buffer = np.concatenate((self.buffer, x))
+        last = self.base + len(self.buffer) - 1
+        # output n needs input up to (n*down)//up + half_taps
+        n_end = ((last - self.half_taps + 1) * self.up + self.down - 1) // self.down
+        return self.__run(n_end)
+
+    def flush(self):
+        '''remaining output of the stream, the future samples are taken as zeros'''
+        self.buffer = np.concatenate((self.buffer, np.zeros(self.half_taps, dtype=np.float32)))
+        n_end = (self.num_input * self.up + self.down - 1) // self.down
+        return self.__run(n_end)
+
+    def __run(self, n_end):
+        if n_end <= self.n:
+            return np.zeros(0, dtype=np.float32)
+        n = np.arange(self.n, n_end)
+        k = n * self.down // self.up
+        phase = n * self.down % self.up
+        frames = self.buffer[k[:, None] + self.offsets[None, :] - self.base]
+        y = np.einsum('ij,ij->i', self.filters[phase], frames)
+        self.n = n_end
+        # drop the input no later output needs
+        keep = self.n * self.down // self.up - self.half_taps + 1
+        if keep > self.base:
+            self.buffer = self.buffer[keep - self.base:]
+            self.base = keep
+        return y
+
 class State(Enum):
     RUNNING=0
     PAUSE=1
 
+class TTSJob:
+    '''one message synthesized ahead, its frames are forwarded after the previous message'''
+    def __init__(self,msg,generation):
+        self.msg = msg
+        self.frames = Queue()
+        self.generation = generation
+
 class BaseTTS:
     def __init__(self, opt, parent:BaseReal):
         self.opt=opt
@@ -47,46 +162,160 @@ class BaseTTS:
         self.msgqueue = Queue()
         self.state = State.RUNNING
 
+        # with prefetch, up to tts_prefetch messages are synthesized while the current one plays
+        self.prefetch = getattr(opt, 'tts_prefetch', 0)
+        self.jobs = Queue(max(self.prefetch,1))
+        self.generation = 0 #bumped by flush_talk, jobs of an older generation are dropped
+        self.local = local() #job of the synthesizing thread
+        self.cache = get_tts_cache(opt)
+        self.http = get_http_session(getattr(opt, 'tts_http_pool', 10))
+
     def flush_talk(self):
         self.msgqueue.queue.clear()
         self.state = State.PAUSE
+        self.generation += 1
+
+    def __cancelled(self,job):
+        return job.generation != self.generation
+
+    def current_generation(self):
+        '''generation of the message synthesized by the calling thread, the stream stops once flush_talk bumps self.generation'''
+        job = getattr(self.local,'job',None)
+        if job is not None:
+            return job.generation
+        return getattr(self.local,'generation',self.generation)
+
+    def put_audio_frame(self,audio_chunk,eventpoint=None):
+        record = getattr(self.local,'record',None)
+        if record is not None:
+            record.append(audio_chunk)
+        job = getattr(self.local,'job',None)
+        if job is None:
+            if getattr(self.local,'generation',self.generation) == self.generation: #not interrupted
+                self.parent.put_audio_frame(audio_chunk,eventpoint)
+        elif not self.__cancelled(job):
+            job.frames.put((audio_chunk,eventpoint))
+
+    def stream_complete(self):
+        '''called by the backend when its stream ended cleanly, only such syntheses are cached'''
+        self.local.complete = True
+
+    def put_stream_tail(self,last_stream,resampler=None):
+        '''end of an utterance: the remain stream and the filter tail of the resampler, zero padded to whole chunks'''
+        if resampler is not None:
+            last_stream = np.concatenate((last_stream,resampler.flush()))
+        for idx in range(0,last_stream.shape[0],self.chunk):
+            chunk = last_stream[idx:idx+self.chunk]
+            if chunk.shape[0] < self.chunk:
+                chunk = np.pad(chunk,(0,self.chunk-chunk.shape[0]))
+            self.put_audio_frame(chunk)
 
     def put_msg_txt(self,msg:str,eventpoint=None): 
         if len(msg)>0:
             self.msgqueue.put((msg,eventpoint))
 
+    def reset(self):
+        self.msgqueue.queue.clear()
+        self.generation += 1
+        self.state = State.RUNNING
+        self.input_stream.seek(0)
+        self.input_stream.truncate()
+
     def render(self,quit_event):
         process_thread = Thread(target=self.process_tts, args=(quit_event,))
         process_thread.start()
+        return process_thread
     
     def process_tts(self,quit_event):        
+        if self.prefetch > 0:
+            self.__process_tts_prefetch(quit_event)
+            return
         while not quit_event.is_set():
             try:
                 msg = self.msgqueue.get(block=True, timeout=1)
                 self.state=State.RUNNING
             except queue.Empty:
                 continue
-            self.txt_to_audio(msg)
+            self.local.generation = self.generation
+            self.cached_txt_to_audio(msg)
         logger.info('ttsreal thread stop')
-    
-    def txt_to_audio(self,msg):
-        pass
-    
 
-###########################################################################################
-class EdgeTTS(BaseTTS):
-    def txt_to_audio(self,msg):
-        voicename = self.opt.REF_FILE #"zh-CN-YunxiaNeural"
+    def __process_tts_prefetch(self,quit_event):
+        executor = ThreadPoolExecutor(max_workers=self.prefetch+1, thread_name_prefix='tts_prefetch')
+        forward_thread = Thread(target=self.__forward_jobs, args=(quit_event,))
+        forward_thread.start()
+        while not quit_event.is_set():
+            try:
+                msg = self.msgqueue.get(block=True, timeout=1)
+                self.state=State.RUNNING
+            except queue.Empty:
+                continue
+            job = TTSJob(msg,self.generation)
+            while not quit_event.is_set(): #bounded look-ahead
+                try:
+                    self.jobs.put(job, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            executor.submit(self.__synthesize, job)
+        forward_thread.join()
+        self.generation += 1
+        executor.shutdown(wait=False)
+        logger.info('ttsreal thread stop')
+
+    def __synthesize(self,job):
+        self.local.job = job
+        try:
+            if not self.__cancelled(job):
+                self.cached_txt_to_audio(job.msg)
+        except Exception:
+            logger.exception('tts prefetch')
+        finally:
+            self.local.job = None
+            job.frames.put(None)
+
+    def __forward_jobs(self,quit_event):
+        # forward the frames of the jobs in message order, cancelled jobs are skipped without waiting
+        while not quit_event.is_set():
+            try:
+                job = self.jobs.get(block=True, timeout=1)
+            except queue.Empty:
+                continue
+            while not self.__cancelled(job) and not quit_event.is_set():
+                try:
+                    item = job.frames.get(block=True, timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                if not self.__cancelled(job):
+                    self.parent.put_audio_frame(*item)
+    
+    def cached_txt_to_audio(self,msg):
+        if self.cache is None:
+            self.txt_to_audio(msg)
+            return
         text,textevent = msg
-        t = time.time()
-        asyncio.new_event_loop().run_until_complete(self.__main(voicename,text))
-        logger.info(f'-------edge tts time:{time.time()-t:.4f}s')
-        if self.input_stream.getbuffer().nbytes<=0: #edgetts err
-            logger.error('edgetts err!!!!!')
+        key = TTSCache.key(type(self).__name__,self.opt,text)
+        stream = self.cache.get(key)
+        if stream is not None:
+            self.__put_stream(stream,msg)
             return
-        
-        self.input_stream.seek(0)
-        stream = self.__create_bytes_stream(self.input_stream)
+
+        generation = self.generation
+        self.local.record = []
+        self.local.complete = False
+        try:
+            self.txt_to_audio(msg)
+        finally:
+            frames = self.local.record
+            self.local.record = None
+        # only complete syntheses are cached: clean end of stream, not interrupted and more than the end frame
+        if self.local.complete and len(frames)>1 and self.state==State.RUNNING and generation==self.generation:
+            self.cache.put(key,np.concatenate(frames))
+
+    def __put_stream(self,stream,msg):
+        text,textevent = msg
         streamlen = stream.shape[0]
         idx=0
         while streamlen >= self.chunk and self.state==State.RUNNING:
@@ -96,46 +325,99 @@ class EdgeTTS(BaseTTS):
                 eventpoint={'status':'start','text':text,'msgevent':textevent}
             elif streamlen<self.chunk:
                 eventpoint={'status':'end','text':text,'msgevent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+            self.put_audio_frame(np.array(stream[idx:idx+self.chunk]),eventpoint)
             idx += self.chunk
-        #if streamlen>0:  #skip last frame(not 20ms)
-        #    self.queue.put(stream[idx:])
-        self.input_stream.seek(0)
-        self.input_stream.truncate() 
-
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
 
-        if stream.ndim > 1:
-            logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
+    def txt_to_audio(self,msg):
+        pass
     
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
 
-        return stream
+###########################################################################################
+_tts_loop = None
+_tts_loop_lock = Lock()
+
+def _get_tts_loop():
+    '''one event loop per process for all edge/doubao tts requests'''
+    global _tts_loop
+    with _tts_loop_lock:
+        if _tts_loop is None:
+            _tts_loop = asyncio.new_event_loop()
+            Thread(target=_tts_loop.run_forever, daemon=True, name="tts_loop").start()
+        return _tts_loop
+
+class EdgeTTS(BaseTTS):
+    def txt_to_audio(self,msg):
+        voicename = self.opt.REF_FILE #"zh-CN-YunxiaNeural"
+        text,textevent = msg
+        t = time.time()
+        # the mp3 chunks come from the shared loop and are decoded here as they arrive
+        mp3_chunks = Queue()
+        future = asyncio.run_coroutine_threadsafe(self.__main(voicename,text,mp3_chunks), _get_tts_loop())
+        codec = av.CodecContext.create('mp3','r')
+        resampler = None
+        last_stream = np.array([],dtype=np.float32)
+        first = True
+        while True:
+            data = mp3_chunks.get()
+            packets = codec.parse(data) #None flushes the parser
+            if data is None:
+                packets.append(None) #flush the decoder
+            for packet in packets:
+                for frame in codec.decode(packet):
+                    stream = frame.to_ndarray()[0].astype(np.float32) #first channel
+                    if frame.sample_rate != self.sample_rate:
+                        if resampler is None:
+                            resampler = StreamResampler(frame.sample_rate,self.sample_rate)
+                        stream = resampler.process(stream)
+                    stream = np.concatenate((last_stream,stream))
+                    streamlen = stream.shape[0]
+                    idx=0
+                    while streamlen >= self.chunk and self.state==State.RUNNING:
+                        eventpoint=None
+                        if first:
+                            eventpoint={'status':'start','text':text,'msgevent':textevent}
+                            logger.info(f'-------edge tts first frame:{time.time()-t:.4f}s')
+                            first = False
+                        self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                        streamlen -= self.chunk
+                        idx += self.chunk
+                    last_stream = stream[idx:] #get the remain stream
+            if data is None:
+                break
+        if future.result():
+            self.stream_complete()
+        logger.info(f'-------edge tts time:{time.time()-t:.4f}s')
+        if first: #edgetts err
+            logger.error('edgetts err!!!!!')
+            return
+        if self.state==State.RUNNING:
+            self.put_stream_tail(last_stream,resampler)
+        eventpoint={'status':'end','text':text,'msgevent':textevent}
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
     
-    async def __main(self,voicename: str, text: str):
+    async def __main(self,voicename: str, text: str, mp3_chunks: Queue) -> bool:
+        '''True if the stream was read to its end'''
+        complete = False
         try:
             communicate = edge_tts.Communicate(text, voicename)
 
             #with open(OUTPUT_FILE, "wb") as file:
-            first = True
             async for chunk in communicate.stream():
-                if first:
-                    first = False
-                if chunk["type"] == "audio" and self.state==State.RUNNING:
+                if self.state!=State.RUNNING:
+                    break
+                if chunk["type"] == "audio":
                     #self.push_audio(chunk["data"])
-                    self.input_stream.write(chunk["data"])
+                    mp3_chunks.put(chunk["data"])
                     #file.write(chunk["data"])
                 elif chunk["type"] == "WordBoundary":
                     pass
+            else:
+                complete = True
         except Exception as e:
             logger.exception('edgetts')
+        finally:
+            mp3_chunks.put(None)
+        return complete
 
 ###########################################################################################
 class FishTTS(BaseTTS):
@@ -148,11 +430,12 @@ class FishTTS(BaseTTS):
                 self.opt.REF_TEXT,
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
+                self.current_generation(),
             ),
             msg
         )
 
-    def fish_speech(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+    def fish_speech(self, text, reffile, reftext,language, server_url, generation) -> Iterator[bytes]:
         start = time.perf_counter()
         req={
             'text':text,
@@ -161,8 +444,9 @@ class FishTTS(BaseTTS):
             'streaming':True,
             'use_memory_cache':'on'
         }
+        res = None
         try:
-            res = requests.post(
+            res = self.http.post(
                 f"{server_url}/v1/tts",
                 json=req,
                 stream=True,
@@ -180,6 +464,8 @@ class FishTTS(BaseTTS):
             first = True
         
             for chunk in res.iter_content(chunk_size=17640): # 1764 44100*20ms*2
+                if generation != self.generation: #flushed, stop reading so the server frees the worker now
+                    break
                 #print('chunk len:',len(chunk))
                 if first:
                     end = time.perf_counter()
@@ -187,17 +473,24 @@ class FishTTS(BaseTTS):
                     first = False
                 if chunk and self.state==State.RUNNING:
                     yield chunk
+            else:
+                self.stream_complete()
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
             logger.exception('fishtts')
+        finally:
+            if res is not None:
+                res.close()
 
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = StreamResampler(44100,self.sample_rate)
+        last_stream = np.array([],dtype=np.float32)
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=44100, sr_new=self.sample_rate)
+                stream = np.concatenate((last_stream,resampler.process(stream)))
                 #byte_stream=BytesIO(buffer)
                 #stream = self.__create_bytes_stream(byte_stream)
                 streamlen = stream.shape[0]
@@ -207,11 +500,14 @@ class FishTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
+                last_stream = stream[idx:] #get the remain stream
+        if not first:
+            self.put_stream_tail(last_stream,resampler)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 class SovitsTTS(BaseTTS):
@@ -224,11 +520,12 @@ class SovitsTTS(BaseTTS):
                 reftext=self.opt.REF_TEXT,
                 language="zh", #en args.language,
                 server_url=self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
+                generation=self.current_generation(),
             ),
             msg
         )
 
-    def gpt_sovits(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+    def gpt_sovits(self, text, reffile, reftext,language, server_url, generation) -> Iterator[bytes]:
         start = time.perf_counter()
         req={
             'text':text,
@@ -245,8 +542,9 @@ class SovitsTTS(BaseTTS):
         # req["emotion"] = emotion
         # #req["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         # req["streaming_mode"] = True
+        res = None
         try:
-            res = requests.post(
+            res = self.http.post(
                 f"{server_url}/tts",
                 json=req,
                 stream=True,
@@ -261,6 +559,8 @@ class SovitsTTS(BaseTTS):
             first = True
         
             for chunk in res.iter_content(chunk_size=None): #12800 1280 32K*20ms*2
+                if generation != self.generation: #flushed, stop reading so the server frees the worker now
+                    break
                 logger.info('chunk len:%d',len(chunk))
                 if first:
                     end = time.perf_counter()
@@ -268,9 +568,14 @@ class SovitsTTS(BaseTTS):
                     first = False
                 if chunk and self.state==State.RUNNING:
                     yield chunk
+            else:
+                self.stream_complete()
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
             logger.exception('sovits')
+        finally:
+            if res is not None:
+                res.close()
 
     def __create_bytes_stream(self,byte_stream):
         #byte_stream=BytesIO(buffer)
@@ -282,21 +587,25 @@ class SovitsTTS(BaseTTS):
             logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
             stream = stream[:, 0]
     
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
-
-        return stream
+        return stream,sample_rate
 
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = None #created with the sample rate of the first chunk
+        last_stream = np.array([],dtype=np.float32)
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 #stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
                 #stream = resampy.resample(x=stream, sr_orig=32000, sr_new=self.sample_rate)
                 byte_stream=BytesIO(chunk)
-                stream = self.__create_bytes_stream(byte_stream)
+                stream,sample_rate = self.__create_bytes_stream(byte_stream)
+                if sample_rate != self.sample_rate and stream.shape[0]>0:
+                    if resampler is None or resampler.sr_orig != sample_rate:
+                        logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
+                        resampler = StreamResampler(sample_rate,self.sample_rate)
+                    stream = resampler.process(stream)
+                stream = np.concatenate((last_stream,stream))
                 streamlen = stream.shape[0]
                 idx=0
                 while streamlen >= self.chunk:
@@ -304,11 +613,14 @@ class SovitsTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
+                last_stream = stream[idx:] #get the remain stream
+        if not first:
+            self.put_stream_tail(last_stream,resampler)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
 
 ###########################################################################################
 class CosyVoiceTTS(BaseTTS):
@@ -321,19 +633,21 @@ class CosyVoiceTTS(BaseTTS):
                 self.opt.REF_TEXT,
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
+                self.current_generation(),
             ),
             msg
         )
 
-    def cosy_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+    def cosy_voice(self, text, reffile, reftext,language, server_url, generation) -> Iterator[bytes]:
         start = time.perf_counter()
         payload = {
             'tts_text': text,
             'prompt_text': reftext
         }
+        res = None
         try:
-            files = [('prompt_wav', ('prompt_wav', open(reffile, 'rb'), 'application/octet-stream'))]
-            res = requests.request("GET", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
+            files = [('prompt_wav', ('prompt_wav', _read_prompt(reffile), 'application/octet-stream'))]
+            res = self.http.request("GET", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
             
             end = time.perf_counter()
             logger.info(f"cosy_voice Time to make POST: {end-start}s")
@@ -345,22 +659,31 @@ class CosyVoiceTTS(BaseTTS):
             first = True
         
             for chunk in res.iter_content(chunk_size=9600): # 960 24K*20ms*2
+                if generation != self.generation: #flushed, stop reading so the server frees the worker now
+                    break
                 if first:
                     end = time.perf_counter()
                     logger.info(f"cosy_voice Time to first chunk: {end-start}s")
                     first = False
                 if chunk and self.state==State.RUNNING:
                     yield chunk
+            else:
+                self.stream_complete()
         except Exception as e:
             logger.exception('cosyvoice')
+        finally:
+            if res is not None:
+                res.close()
 
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = StreamResampler(24000,self.sample_rate)
+        last_stream = np.array([],dtype=np.float32)
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
+                stream = np.concatenate((last_stream,resampler.process(stream)))
                 #byte_stream=BytesIO(buffer)
                 #stream = self.__create_bytes_stream(byte_stream)
                 streamlen = stream.shape[0]
@@ -370,11 +693,14 @@ class CosyVoiceTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
+                last_stream = stream[idx:] #get the remain stream
+        if not first:
+            self.put_stream_tail(last_stream,resampler)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 _PROTOCOL = "https://"
@@ -434,11 +760,12 @@ class TencentTTS(BaseTTS):
                 self.opt.REF_TEXT,
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
+                self.current_generation(),
             ),
             msg
         )
 
-    def tencent_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+    def tencent_voice(self, text, reffile, reftext,language, server_url, generation) -> Iterator[bytes]:
         start = time.perf_counter()
         session_id = str(uuid.uuid1())
         params = self.__gen_params(session_id, text)
@@ -448,8 +775,9 @@ class TencentTTS(BaseTTS):
             "Authorization": str(signature)
         }
         url = _PROTOCOL + _HOST + _PATH
+        res = None
         try:
-            res = requests.post(url, headers=headers,
+            res = self.http.post(url, headers=headers,
                           data=json.dumps(params), stream=True)
             
             end = time.perf_counter()
@@ -458,6 +786,8 @@ class TencentTTS(BaseTTS):
             first = True
         
             for chunk in res.iter_content(chunk_size=6400): # 640 16K*20ms*2
+                if generation != self.generation: #flushed, stop reading so the server frees the worker now
+                    break
                 #logger.info('chunk len:%d',len(chunk))
                 if first:
                     try:
@@ -472,8 +802,13 @@ class TencentTTS(BaseTTS):
                         first = False                    
                 if chunk and self.state==State.RUNNING:
                     yield chunk
+            else:
+                self.stream_complete()
         except Exception as e:
             logger.exception('tencent')
+        finally:
+            if res is not None:
+                res.close()
 
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
@@ -493,16 +828,121 @@ class TencentTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
                 last_stream = stream[idx:] #get the remain stream
+        if not first:
+            self.put_stream_tail(last_stream)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 
 
+class DoubaoConnectionPool:
+    """
+    Idle websocket connections to one doubao endpoint, reused by the sequential requests of
+    all sessions instead of a handshake per sentence.
+
+    Audio frames of the binary protocol carry no request id, so a connection serves one
+    request at a time; concurrent sentences take another idle connection or open a new one.
+    Only used from the shared tts loop, so no locking.
+    """
+    def __init__(self, url, headers, max_idle=4, retries=3):
+        self.url = url
+        self.headers = headers
+        self.max_idle = max_idle
+        self.retries = retries
+        self.idle = []
+
+    async def acquire(self):
+        while self.idle:
+            ws = self.idle.pop()
+            if ws.open:
+                return ws, True
+        for attempt in range(self.retries+1):
+            try:
+                logger.info(f"🔌 正在连接豆包WebSocket: {self.url}")
+                ws = await websockets.connect(self.url, extra_headers=self.headers, ping_interval=None)
+                return ws, False
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = 0.5 * 2**attempt
+                logger.warning(f"doubao connect failed: {e}, retry in {delay}s")
+                await asyncio.sleep(delay)
+
+    async def release(self, ws, reusable):
+        if reusable and ws.open and len(self.idle) < self.max_idle:
+            self.idle.append(ws)
+        else:
+            await ws.close()
+
+_doubao_pools = {}
+
+def get_doubao_pool(url, headers):
+    key = (url, headers.get("Authorization"))
+    if key not in _doubao_pools:
+        _doubao_pools[key] = DoubaoConnectionPool(url, headers)
+    return _doubao_pools[key]
+
+async def _doubao_request(pool, request, running=lambda: True):
+    """
+    send one full client request and yield the pcm payload of every audio-only response as a
+    memoryview into the received frame. The connection goes back to the pool only after the
+    last (negative sequence) frame was read.
+    """
+    for attempt in range(2):
+        ws, reused = await pool.acquire()
+        try:
+            await ws.send(request)
+            break
+        except websockets.ConnectionClosed:
+            await pool.release(ws, False)
+            if not reused or attempt == 1: #an idle connection may have been closed by the server
+                raise
+    done = False
+    try:
+        while running():
+            res = await ws.recv()
+            header_size = res[0] & 0x0f
+            message_type = res[1] >> 4
+            message_type_specific_flags = res[1] & 0x0f
+            offset = header_size*4
+            view = memoryview(res)
+
+            if message_type == 0xb:  # audio-only server response
+                if message_type_specific_flags == 0:  # no sequence number as ACK
+                    continue
+                sequence_number = int.from_bytes(view[offset:offset+4], "big", signed=True)
+                yield view[offset+8:]
+                if sequence_number < 0:
+                    done = True
+                    break
+            elif message_type == 0xf:  # 错误消息 (MsgType.Error)
+                # Error消息格式（在header之后）：
+                # - error_code (4 bytes, uint32)
+                # - payload_size (4 bytes, uint32)
+                # - payload_data (variable)
+                if len(res) - offset >= 8:
+                    error_code = int.from_bytes(view[offset:offset+4], "big", signed=False)
+                    payload_size = int.from_bytes(view[offset+4:offset+8], "big", signed=False)
+                    error_text = bytes(view[offset+8:offset+8+payload_size]).decode('utf-8', 'ignore')
+                    logger.error(f"❌ 豆包API错误:")
+                    logger.error(f"   错误码: {error_code}")
+                    logger.error(f"   错误信息: {error_text}")
+                else:
+                    logger.error(f"❌ 收到错误消息(类型15)，但payload太短: {len(res) - offset} bytes")
+                    logger.error(f"   原始hex: {res[offset:].hex()}")
+                raise RuntimeError('doubao error response')
+            else:
+                logger.warning(f"⚠️ 收到未知消息类型: {message_type}, flags: {message_type_specific_flags}")
+                raise RuntimeError(f'doubao unknown message type {message_type}')
+    finally:
+        # interrupted or failed requests leave unread frames behind, close those connections
+        await pool.release(ws, done)
+
 class DoubaoTTS(BaseTTS):
     def __init__(self, opt, parent):
         super().__init__(opt, parent)
@@ -567,129 +1007,73 @@ class DoubaoTTS(BaseTTS):
                 "operation": "xxx"
             }
         }
+        self.request_json["audio"]["voice_type"] = opt.REF_FILE
+        header = {"Authorization": f"Bearer;{self.token}"}  # 注意：Bearer后面没有空格！
+        self.pool = get_doubao_pool(self.api_url, header)
+
+    def __build_request(self, text):
+        # 协议头：版本1, header_size=1(4字节), FullClientRequest(1), NoSeq(0), JSON(1), 无压缩(0)
+        request_json = {
+            "app": self.request_json["app"],
+            "user": {"uid": str(self.parent.sessionid)},
+            "audio": self.request_json["audio"],
+            "request": {
+                "reqid": str(uuid.uuid4()),
+                "text": text,
+                "text_type": "plain",
+                "operation": "submit"
+            }
+        }
+        payload_bytes = json.dumps(request_json).encode()
+        logger.debug(f"请求体: {json.dumps(request_json, ensure_ascii=False, indent=2)}")
+        return b'\x11\x10\x10\x00' + len(payload_bytes).to_bytes(4, 'big') + payload_bytes
 
-    async def doubao_voice(self, text): # -> Iterator[bytes]:
+    async def doubao_voice(self, text, chunks: Queue) -> bool:
+        '''True if the request ended without an error'''
         start = time.perf_counter()
-        voice_type = self.opt.REF_FILE
-
-        logger.info(f"🎤 豆包TTS开始合成: '{text[:50]}...' (音色: {voice_type})")
-
+        logger.info(f"🎤 豆包TTS开始合成: '{text[:50]}...' (音色: {self.opt.REF_FILE})")
+        first = True
+        chunk_count = 0
+        total_bytes = 0
         try:
-            # 创建请求对象
-            # 协议头：版本1, header_size=1(4字节), FullClientRequest(1), NoSeq(0), JSON(1), 无压缩(0)
-            default_header = bytearray(b'\x11\x10\x10\x00')  # 改为不压缩（第3字节从\x11改为\x10）
-            submit_request_json = copy.deepcopy(self.request_json)
-            submit_request_json["user"]["uid"] = str(self.parent.sessionid)
-            submit_request_json["audio"]["voice_type"] = voice_type
-            submit_request_json["request"]["text"] = text
-            submit_request_json["request"]["reqid"] = str(uuid.uuid4())
-            submit_request_json["request"]["operation"] = "submit"
-            payload_bytes = str.encode(json.dumps(submit_request_json))
-            # payload_bytes = gzip.compress(payload_bytes)  # 禁用压缩，对齐官方示例
-            full_client_request = bytearray(default_header)
-            full_client_request.extend((len(payload_bytes)).to_bytes(4, 'big'))  # payload size(4 bytes)
-            full_client_request.extend(payload_bytes)  # payload
-
-            logger.info(f"🔌 正在连接豆包WebSocket: {self.api_url}")
-            header = {"Authorization": f"Bearer;{self.token}"}  # 注意：Bearer后面没有空格！
-            first = True
-
-            # 调试：打印请求内容
-            logger.debug(f"请求体: {json.dumps(submit_request_json, ensure_ascii=False, indent=2)}")
-            logger.debug(f"Header: {header}")
-
-            async with websockets.connect(self.api_url, extra_headers=header, ping_interval=None) as ws:
-                logger.info(f"✅ WebSocket连接成功，发送请求...")
-                await ws.send(full_client_request)
-                chunk_count = 0
-                total_bytes = 0
-                while True:
-                    res = await ws.recv()
-                    header_size = res[0] & 0x0f
-                    message_type = res[1] >> 4
-                    message_type_specific_flags = res[1] & 0x0f
-                    payload = res[header_size*4:]
-
-                    if message_type == 0xb:  # audio-only server response
-                        if message_type_specific_flags == 0:  # no sequence number as ACK
-                            continue
-                        else:
-                            if first:
-                                end = time.perf_counter()
-                                logger.info(f"⚡ 首帧延迟: {(end-start)*1000:.1f}ms")
-                                first = False
-                            sequence_number = int.from_bytes(payload[:4], "big", signed=True)
-                            payload_size = int.from_bytes(payload[4:8], "big", signed=False)
-                            payload = payload[8:]
-                            chunk_count += 1
-                            total_bytes += len(payload)
-                            yield payload
-                        if sequence_number < 0:
-                            logger.info(f"✅ 豆包TTS完成: 共{chunk_count}个音频块, {total_bytes}字节")
-                            break
-                    elif message_type == 0xf:  # 错误消息 (MsgType.Error)
-                        try:
-                            # Error消息格式（在header之后）：
-                            # - error_code (4 bytes, uint32)
-                            # - payload_size (4 bytes, uint32)
-                            # - payload_data (variable)
-                            if len(payload) >= 8:
-                                error_code = int.from_bytes(payload[:4], "big", signed=False)
-                                payload_size = int.from_bytes(payload[4:8], "big", signed=False)
-                                error_payload = payload[8:8+payload_size]
-                                error_text = error_payload.decode('utf-8', 'ignore')
-                                logger.error(f"❌ 豆包API错误:")
-                                logger.error(f"   错误码: {error_code}")
-                                logger.error(f"   错误信息: {error_text}")
-                                try:
-                                    error_json = json.loads(error_text)
-                                    logger.error(f"   详细: {json.dumps(error_json, ensure_ascii=False, indent=2)}")
-                                except:
-                                    pass
-                            else:
-                                logger.error(f"❌ 收到错误消息(类型15)，但payload太短: {len(payload)} bytes")
-                                logger.error(f"   原始hex: {payload.hex()}")
-                        except Exception as parse_err:
-                            logger.error(f"❌ 解析错误消息失败: {parse_err}")
-                            logger.error(f"   原始payload长度: {len(payload)} bytes")
-                            logger.error(f"   Hex: {payload[:100].hex()}")
-                        break
-                    else:
-                        logger.warning(f"⚠️ 收到未知消息类型: {message_type}, flags: {message_type_specific_flags}")
-                        break
+            async for payload in _doubao_request(self.pool, self.__build_request(text), lambda: self.state==State.RUNNING):
+                if first:
+                    end = time.perf_counter()
+                    logger.info(f"⚡ 首帧延迟: {(end-start)*1000:.1f}ms")
+                    first = False
+                chunk_count += 1
+                total_bytes += len(payload)
+                chunks.put(payload)
+            logger.info(f"✅ 豆包TTS完成: 共{chunk_count}个音频块, {total_bytes}字节")
+            return True
         except Exception as e:
             logger.error(f"❌ 豆包TTS异常: {e}")
             logger.exception('doubao')
-        # # 检查响应状态码
-        # if response.status_code == 200:
-        #     # 处理响应数据
-        #     audio_data = base64.b64decode(response.json().get('data'))
-        #     yield audio_data
-        # else:
-        #     logger.error(f"请求失败，状态码: {response.status_code}")
-        #     return
+            return False
+        finally:
+            chunks.put(None)
 
     def txt_to_audio(self, msg):
         text, textevent = msg
         logger.info(f"📝 收到TTS文本消息: '{text[:100]}...'")
         try:
-            asyncio.new_event_loop().run_until_complete(
-                self.stream_tts(
-                    self.doubao_voice(text),
-                    msg
-                )
-            )
+            # the websocket lives on the shared loop, the pcm is cut into frames here
+            chunks = Queue()
+            future = asyncio.run_coroutine_threadsafe(self.doubao_voice(text, chunks), _get_tts_loop())
+            self.stream_tts(iter(chunks.get, None), msg)
+            if future.result():
+                self.stream_complete()
             logger.info(f"✅ TTS处理完成")
         except Exception as e:
             logger.error(f"❌ txt_to_audio异常: {e}")
             logger.exception('txt_to_audio')
 
-    async def stream_tts(self, audio_stream, msg):
+    def stream_tts(self, audio_stream, msg):
         text, textevent = msg
         first = True
         last_stream = np.array([],dtype=np.float32)
         frame_count = 0
-        async for chunk in audio_stream:
+        for chunk in audio_stream:
             if chunk is not None and len(chunk) > 0:
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
                 stream = np.concatenate((last_stream,stream))
@@ -701,13 +1085,13 @@ class DoubaoTTS(BaseTTS):
                         eventpoint = {'status': 'start', 'text': text, 'msgenvent': textevent}
                         logger.info(f"🔊 开始播放音频")
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx + self.chunk], eventpoint)
+                    self.put_audio_frame(stream[idx:idx + self.chunk], eventpoint)
                     frame_count += 1
                     streamlen -= self.chunk
                     idx += self.chunk
                 last_stream = stream[idx:] #get the remain stream
         eventpoint = {'status': 'end', 'text': text, 'msgenvent': textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk, np.float32), eventpoint)
+        self.put_audio_frame(np.zeros(self.chunk, np.float32), eventpoint)
         logger.info(f"🎵 音频流结束，共发送{frame_count}帧")
 
 ###########################################################################################
@@ -724,23 +1108,26 @@ class XTTS(BaseTTS):
                 self.speaker,
                 "zh-cn", #en args.language,
                 self.opt.TTS_SERVER, #"http://localhost:9000", #args.server_url,
-                "20" #args.stream_chunk_size
+                "20", #args.stream_chunk_size
+                self.current_generation(),
             ),
             msg
         )
 
     def get_speaker(self,ref_audio,server_url):
-        files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
-        response = requests.post(f"{server_url}/clone_speaker", files=files)
+        files = {"wav_file": ("reference.wav", _read_prompt(ref_audio))}
+        response = self.http.post(f"{server_url}/clone_speaker", files=files)
         return response.json()
 
-    def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
+    def xtts(self,text, speaker, language, server_url, stream_chunk_size, generation) -> Iterator[bytes]:
         start = time.perf_counter()
+        speaker = dict(speaker) #shared by prefetch threads
         speaker["text"] = text
         speaker["language"] = language
         speaker["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
+        res = None
         try:
-            res = requests.post(
+            res = self.http.post(
                 f"{server_url}/tts_stream",
                 json=speaker,
                 stream=True,
@@ -755,22 +1142,31 @@ class XTTS(BaseTTS):
             first = True
         
             for chunk in res.iter_content(chunk_size=9600): #24K*20ms*2
+                if generation != self.generation: #flushed, stop reading so the server frees the worker now
+                    break
                 if first:
                     end = time.perf_counter()
                     logger.info(f"xtts Time to first chunk: {end-start}s")
                     first = False
                 if chunk:
                     yield chunk
+            else:
+                self.stream_complete()
         except Exception as e:
             print(e)
+        finally:
+            if res is not None:
+                res.close()
     
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = StreamResampler(24000,self.sample_rate)
+        last_stream = np.array([],dtype=np.float32)
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
+                stream = np.concatenate((last_stream,resampler.process(stream)))
                 #byte_stream=BytesIO(buffer)
                 #stream = self.__create_bytes_stream(byte_stream)
                 streamlen = stream.shape[0]
@@ -780,8 +1176,11 @@ class XTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
+                last_stream = stream[idx:] #get the remain stream
+        if not first:
+            self.put_stream_tail(last_stream,resampler)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
@@ -12,11 +12,17 @@ class Audio2Feature():
 
     @torch.no_grad()
     def get_hubert_from_16k_speech(self, speech):
+        return self.get_hubert_from_input_values(self.get_input_values(speech))
+
+    def get_input_values(self, speech):
+        """processor output of speech, normalized over the whole of it"""
         if speech.ndim == 2:
             speech = speech[:, 0]  # [T, 2] ==> [T,]
         input_values_all = self.processor(speech, return_tensors="pt", sampling_rate=16000).input_values  # [1, T]
-        input_values_all = input_values_all.to(self.device)
-	    
+        return input_values_all.to(self.device)
+
+    @torch.no_grad()
+    def get_hubert_from_input_values(self, input_values_all):
         kernel = 400
         stride = 320
         clip_length = stride * 1000
@@ -94,3 +100,92 @@ class Audio2Feature():
             i += 1
 
         return whisper_chunks
+
+
+class HubertFeatureCache():
+    """
+    Per-session cache of hubert hidden states for a sliding audio window.
+
+    HubertASR feeds a window that overlaps the previous one by `overlap` (l+r) tokens.
+    Hidden states of overlapping tokens that had `margin` tokens of right context in the
+    previous window are kept, the rest of the window is encoded with `margin` tokens of
+    left context. That skips overlap - 2*margin tokens of the encoder per step, so margin
+    defaults to overlap//4 and stays below overlap/2; when nothing is left to skip the
+    cache is disabled and every window is encoded in full.
+
+    The window is normalized as a whole before the slice is encoded, as in a full encode.
+    Reused tokens still come from the previous window (other normalization statistics and
+    attention context). For debugging, every drift_interval steps (0: never) the full window
+    is encoded as well and the mean absolute difference relative to it is kept in `drift`.
+    """
+    def __init__(self, audio_processor:Audio2Feature, overlap, margin=None, drift_interval=0):
+        self.audio_processor = audio_processor
+        if margin is None:
+            margin = overlap // 4
+        self.margin = max(1, min(margin, (overlap-1)//2)) # tokens(20ms) of context re-encoded on each side of the new audio
+        self.enabled = overlap - 2*self.margin > 0
+        self.drift_interval = drift_interval
+        self.drift = 0.
+        self.hits = 0 # tokens the encoder skipped
+        self.requests = 0
+        self.steps = 0
+        self.reset()
+
+    def reset(self):
+        self.feats = None # [T, 1024] hidden states of the last window
+        self.feat_start = 0 # stream token index of self.feats[0]
+        self.stable_end = 0 # tokens before this index have enough right context to be reused
+        self.num_samples = 0
+
+    @property
+    def cache_size(self):
+        """number of cached token features that can be reused by the next window"""
+        if self.feats is None:
+            return 0
+        return max(0, self.stable_end - self.feat_start)
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.requests if self.requests > 0 else 0.
+
+    def get_hubert_from_16k_speech(self, speech, new_samples=None):
+        """same output as Audio2Feature.get_hubert_from_16k_speech(speech) for the window,
+        new_samples is the length of the audio at the end of speech not seen in the previous call"""
+        if not self.enabled:
+            return self.audio_processor.get_hubert_from_16k_speech(speech)
+        kernel = 400
+        stride = 320
+        if new_samples is None or self.feats is None:
+            self.reset()
+            self.num_samples = len(speech)
+        else:
+            self.num_samples += new_samples
+        window_start = self.num_samples - len(speech)
+        start_tok = window_start // stride
+        expected_T = (len(speech) - (kernel-stride)) // stride
+        end_tok = start_tok + expected_T
+
+        reuse_end = start_tok
+        if self.feats is not None and window_start % stride == 0 and self.feat_start <= start_tok:
+            reuse_end = min(max(self.stable_end, start_tok), end_tok)
+        enc_start = max(start_tok, reuse_end - self.margin)
+
+        input_values = self.audio_processor.get_input_values(speech)
+        res_lst = []
+        if reuse_end > start_tok:
+            res_lst.append(self.feats[start_tok-self.feat_start:reuse_end-self.feat_start])
+        if reuse_end < end_tok:
+            hidden_states = self.audio_processor.get_hubert_from_input_values(input_values[:, (enc_start-start_tok)*stride:])
+            res_lst.append(hidden_states[reuse_end-enc_start:])
+        ret = torch.cat(res_lst, dim=0)
+
+        self.hits += enc_start - start_tok
+        self.requests += expected_T
+        self.steps += 1
+        if self.drift_interval > 0 and self.steps % self.drift_interval == 0:
+            full = self.audio_processor.get_hubert_from_input_values(input_values)
+            self.drift = ((ret - full).abs().mean() / full.abs().mean().clamp(min=1e-6)).item()
+        self.feats = ret
+        self.feat_start = start_tok
+        self.stable_end = end_tok - self.margin
+        return ret
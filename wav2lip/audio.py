@@ -44,12 +44,73 @@ def linearspectrogram(wav):
 
 def melspectrogram(wav):
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
+    return _stft_to_mel(D)
+
+def _stft_to_mel(D):
     S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
+class MelStream:
+    """Incremental melspectrogram over a continuous 16k pcm stream.
+
+    Pre-emphasis filter state and the last n_fft-hop samples are kept between calls,
+    so push() only transforms the hop frames completed by the new audio. Column j is
+    centered on stream sample j*hop_size, the same grid melspectrogram() uses for a
+    window starting at sample 0.
+    """
+    def __init__(self, max_cols=400):
+        self.hop_size = get_hop_size()
+        self.n_fft = hp.n_fft
+        self.max_cols = max_cols
+        self.reset()
+
+    def reset(self):
+        self.num_samples = 0 # pcm samples pushed so far
+        self._zi = np.zeros(1)
+        # zero padding in front of the stream, as center=True stft would do
+        self._samples = np.zeros(self.n_fft // 2)
+        self._sample_offset = -(self.n_fft // 2) # stream index of self._samples[0]
+        self._mel = np.zeros((hp.num_mels, 0))
+        self._col_offset = 0 # index of self._mel[:, 0]
+
+    @property
+    def num_cols(self):
+        """number of complete mel columns computed so far"""
+        return self._col_offset + self._mel.shape[1]
+
+    def push(self, wav):
+        if hp.preemphasize:
+            wav, self._zi = signal.lfilter([1, -hp.preemphasis], [1], wav, zi=self._zi)
+        self.num_samples += len(wav)
+        self._samples = np.concatenate((self._samples, wav))
+
+        # column j covers stream samples [j*hop - n_fft/2, j*hop + n_fft/2)
+        start = self.num_cols * self.hop_size - self.n_fft // 2 - self._sample_offset
+        if len(self._samples) - start < self.n_fft:
+            return
+        n_new = (len(self._samples) - start - self.n_fft) // self.hop_size + 1
+        segment = self._samples[start:start + (n_new - 1) * self.hop_size + self.n_fft]
+        D = librosa.stft(y=segment, n_fft=self.n_fft, hop_length=self.hop_size, win_length=hp.win_size, center=False)
+        self._mel = np.concatenate((self._mel, _stft_to_mel(D)), axis=1)
+
+        # drop samples no future column needs, and columns beyond max_cols
+        start += n_new * self.hop_size
+        self._samples = self._samples[start:]
+        self._sample_offset += start
+        if self._mel.shape[1] > self.max_cols:
+            drop = self._mel.shape[1] - self.max_cols
+            self._mel = self._mel[:, drop:]
+            self._col_offset += drop
+
+    def get_chunk(self, start_col, mel_step_size=16):
+        """mel[:, start_col:start_col+mel_step_size] in stream column index, clamped to the computed range"""
+        start_col = min(start_col, self.num_cols - mel_step_size) - self._col_offset
+        start_col = max(0, start_col)
+        return self._mel[:, start_col:start_col + mel_step_size]
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
@@ -26,6 +26,7 @@ from av.packet import Packet
 from av import AudioFrame
 import fractions
 import numpy as np
+from collections import deque
 
 AUDIO_PTIME = 0.020  # 20ms audio packetization
 VIDEO_CLOCK_RATE = 90000
@@ -45,96 +46,202 @@ logger = logging.getLogger(__name__)
 from logger import logger as mylogger
 
 
+class FrameQueue:
+    """
+    Frames handed from the render thread to a track.
+
+    put_frames appends to a deque from any thread and wakes the event loop only when recv
+    is actually waiting, with one call_soon_threadsafe for all the queues of a batch; get
+    pops without creating a coroutine per frame. Replaces asyncio.Queue plus one
+    run_coroutine_threadsafe per frame.
+    """
+    def __init__(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._items = deque()
+        self._waiter = None #future of a get waiting on an empty queue
+        self._lock = threading.Lock()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def clear(self):
+        self._items.clear()
+
+    def put_nowait(self, item):
+        '''from the event loop thread'''
+        _wake_waiters([self._extend([item])])
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def get_nowait(self):
+        '''next item or None'''
+        with self._lock:
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    async def get(self):
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._items.popleft()
+                waiter = self._waiter = self._loop.create_future()
+            await waiter
+
+    def drop_oldest(self, keep):
+        '''drop items from the front until keep are left, return the dropped items'''
+        with self._lock:
+            return [self._items.popleft() for _ in range(len(self._items) - keep)]
+
+    def _extend(self, items):
+        '''append items, return the future of a waiting get that has to be woken'''
+        with self._lock:
+            self._items.extend(items)
+            waiter, self._waiter = self._waiter, None
+            return waiter
+
+def _wake_waiters(waiters):
+    for waiter in waiters:
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+def put_frames(loop, batch):
+    '''
+    hand [(FrameQueue, items), ...] over from another thread, one loop wakeup for the whole
+    batch and none when no track is waiting
+    '''
+    waiters = [q._extend(items) for q, items in batch]
+    if any(waiter is not None for waiter in waiters):
+        loop.call_soon_threadsafe(_wake_waiters, waiters)
+
+class MediaClock:
+    """
+    Wall clock shared by the audio and video track of one player.
+
+    Slot n of a track with packet time ptime is sent at start + n*ptime. Both tracks count
+    from the same start, so they cannot drift apart the way two tracks anchored at their
+    own first frame did.
+    """
+    def __init__(self):
+        self.start = None
+
+    def now(self) -> float:
+        '''media time in seconds, starts the clock on first use'''
+        if self.start is None:
+            self.start = time.time()
+            mylogger.info('media clock start:%f', self.start)
+        return time.time() - self.start
+
+    async def wait(self, media_time):
+        wait = media_time - self.now()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
 class PlayerStreamTrack(MediaStreamTrack):
     """
-    A video track that returns an animated flag.
+    Audio or video track of a HumanPlayer, paced by the player's MediaClock.
+
+    _queue is the jitter buffer. When the producer runs ahead and more than max_depth frames
+    are queued, the oldest are dropped (their eventpoints are still notified). When it falls
+    behind and nothing arrives within half a frame of the slot time, video repeats the last
+    frame and audio sends silence, so the clock never stalls.
     """
 
-    def __init__(self, player, kind):
+    def __init__(self, player, kind, max_depth):
         super().__init__()  # don't forget this!
         self.kind = kind
         self._player = player
-        self._queue = asyncio.Queue()
-        self.timelist = [] #记录最近包的时间戳
-        self.current_frame_count = 0
+        self._queue = FrameQueue()
+        self.max_depth = max_depth
+        self._ptime = VIDEO_PTIME if kind == 'video' else AUDIO_PTIME
+        self._slot = None #next slot to send, None before the first frame
+        self._last = None #last video frame, repeated on underflow
+        self.sent = 0
+        self.dropped = 0
+        self.repeated = 0
         if self.kind == 'video':
             self.framecount = 0
             self.lasttime = time.perf_counter()
             self.totaltime = 0
-    
-    _start: float
-    _timestamp: int
 
-    async def next_timestamp(self) -> Tuple[int, fractions.Fraction]:
-        if self.readyState != "live":
-            raise Exception
+    def media_time(self) -> float:
+        '''media time of the next slot'''
+        return (self._slot or 0) * self._ptime
 
-        if self.kind == 'video':
-            if hasattr(self, "_timestamp"):
-                #self._timestamp = (time.time()-self._start) * VIDEO_CLOCK_RATE
-                self._timestamp += int(VIDEO_PTIME * VIDEO_CLOCK_RATE)
-                self.current_frame_count += 1
-                wait = self._start + self.current_frame_count * VIDEO_PTIME - time.time()
-                # wait = self.timelist[0] + len(self.timelist)*VIDEO_PTIME - time.time()               
-                if wait>0:
-                    await asyncio.sleep(wait)
-                # if len(self.timelist)>=100:
-                #     self.timelist.pop(0)
-                # self.timelist.append(time.time())
-            else:
-                self._start = time.time()
-                self._timestamp = 0
-                self.timelist.append(self._start)
-                mylogger.info('video start:%f',self._start)
-            return self._timestamp, VIDEO_TIME_BASE
-        else: #audio
-            if hasattr(self, "_timestamp"):
-                #self._timestamp = (time.time()-self._start) * SAMPLE_RATE
-                self._timestamp += int(AUDIO_PTIME * SAMPLE_RATE)
-                self.current_frame_count += 1
-                wait = self._start + self.current_frame_count * AUDIO_PTIME - time.time()
-                # wait = self.timelist[0] + len(self.timelist)*AUDIO_PTIME - time.time()
-                if wait>0:
-                    await asyncio.sleep(wait)
-                # if len(self.timelist)>=200:
-                #     self.timelist.pop(0)
-                #     self.timelist.pop(0)
-                # self.timelist.append(time.time())
-            else:
-                self._start = time.time()
-                self._timestamp = 0
-                self.timelist.append(self._start)
-                mylogger.info('audio start:%f',self._start)
-            return self._timestamp, AUDIO_TIME_BASE
+    def __taken(self, n=1):
+        # every video frame leaving the buffer gives the render loop a credit back
+        if self.kind == 'video' and n > 0:
+            self._player.grant(n)
+
+    def __stale(self, generation):
+        # speech queued before the last interrupt
+        return generation is not None and generation != self._player.generation
+
+    async def __next_item(self):
+        dropped = self._queue.drop_oldest(self.max_depth)
+        for frame,eventpoint,generation in dropped:
+            if eventpoint:
+                self._player.notify(eventpoint)
+        self.dropped += len(dropped)
+        self.__taken(len(dropped))
+        clock = self._player.clock
+        if self._slot is None: #first frame, join the clock at the current slot
+            while True:
+                item = await self._queue.get()
+                self.__taken()
+                if not (self.kind == 'video' and self.__stale(item[2])): #stale video is skipped
+                    break
+            self._slot = int(clock.now() / self._ptime)
+            return item
+        await clock.wait(self._slot * self._ptime)
+        deadline = clock.start + (self._slot + 0.5) * self._ptime
+        while True:
+            item = self._queue.get_nowait()
+            if item is None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return None
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    return None
+            self.__taken()
+            if self.kind == 'video' and self.__stale(item[2]): #stale video is skipped
+                continue
+            return item
 
     async def recv(self) -> Union[Frame, Packet]:
-        # frame = self.frames[self.counter % 30]            
+        if self.readyState != "live":
+            raise Exception
         self._player._start(self)
-        # if self.kind == 'video':
-        #     frame = await self._queue.get()
-        # else: #audio
-        #     if hasattr(self, "_timestamp"):
-        #         wait = self._start + self._timestamp / SAMPLE_RATE + AUDIO_PTIME - time.time()
-        #         if wait>0:
-        #             await asyncio.sleep(wait)
-        #         if self._queue.qsize()<1:
-        #             #frame = AudioFrame(format='s16', layout='mono', samples=320)
-        #             audio = np.zeros((1, 320), dtype=np.int16)
-        #             frame = AudioFrame.from_ndarray(audio, layout='mono', format='s16')
-        #             frame.sample_rate=16000
-        #         else:
-        #             frame = await self._queue.get()
-        #     else:
-        #         frame = await self._queue.get()
-        frame,eventpoint = await self._queue.get()
-        pts, time_base = await self.next_timestamp()
-        frame.pts = pts
-        frame.time_base = time_base
-        if eventpoint:
-            self._player.notify(eventpoint)
+        item = await self.__next_item()
+        if item is None: #underflow
+            self.repeated += 1
+            frame,eventpoint,generation = (self._last if self.kind == 'video' else self.__silence(None)),None,None
+        else:
+            frame,eventpoint,generation = item
         if frame is None:
             self.stop()
             raise Exception
+        if self.kind == 'audio' and self.__stale(generation): #stale audio is sent as silence to keep the clock
+            frame = self.__silence(frame)
+            eventpoint = None
+        self._player.report_interrupt(self.kind)
+        if self.kind == 'video':
+            self._last = frame
+            frame.pts = self._slot * int(VIDEO_PTIME * VIDEO_CLOCK_RATE)
+            frame.time_base = VIDEO_TIME_BASE
+        else:
+            frame.pts = self._slot * int(AUDIO_PTIME * SAMPLE_RATE)
+            frame.time_base = AUDIO_TIME_BASE
+        self._slot += 1
+        self.sent += 1
+        if eventpoint:
+            self._player.notify(eventpoint)
         if self.kind == 'video':
             self.totaltime += (time.perf_counter() - self.lasttime)
             self.framecount += 1
@@ -143,7 +250,14 @@ class PlayerStreamTrack(MediaStreamTrack):
                 mylogger.info(f"------actual avg final fps:{self.framecount/self.totaltime:.4f}")
                 self.framecount = 0
                 self.totaltime=0
+                self._player.update_stats()
         return frame
+
+    def __silence(self, frame):
+        samples = frame.samples if frame is not None else int(AUDIO_PTIME * SAMPLE_RATE)
+        silence = AudioFrame.from_ndarray(np.zeros((1, samples), dtype=np.int16), layout='mono', format='s16')
+        silence.sample_rate = SAMPLE_RATE
+        return silence
     
     def stop(self):
         super().stop()
@@ -173,14 +287,46 @@ class HumanPlayer:
         self.__audio: Optional[PlayerStreamTrack] = None
         self.__video: Optional[PlayerStreamTrack] = None
 
-        self.__audio = PlayerStreamTrack(self, kind="audio")
-        self.__video = PlayerStreamTrack(self, kind="video")
+        # one clock for both tracks; the jitter buffers hold up to 3 inference batches
+        self.clock = MediaClock()
+        max_depth = 3*nerfreal.opt.batch_size
+        self.__audio = PlayerStreamTrack(self, kind="audio", max_depth=2*max_depth)
+        self.__video = PlayerStreamTrack(self, kind="video", max_depth=max_depth)
 
         self.__container = nerfreal
 
     def notify(self,eventpoint):
         self.__container.notify(eventpoint)
 
+    @property
+    def generation(self) -> int:
+        return self.__container.generation if self.__container is not None else 0
+
+    def report_interrupt(self,kind):
+        if self.__container is not None:
+            self.__container.report_interrupt(kind)
+
+    def grant(self, n):
+        if self.__container is not None:
+            self.__container.credits.grant(n)
+
+    def update_stats(self):
+        '''buffer depth, drop/repeat counts and a/v drift, logged and kept in BaseReal.media_stats'''
+        audio, video = self.__audio, self.__video
+        stats = {
+            'audio_depth': audio._queue.qsize(),
+            'video_depth': video._queue.qsize(),
+            'audio_dropped': audio.dropped,
+            'video_dropped': video.dropped,
+            'audio_repeated': audio.repeated,
+            'video_repeated': video.repeated,
+            'av_drift_ms': round((audio.media_time() - video.media_time())*1000, 1),
+            'clock_lag_ms': round((self.clock.now() - video.media_time())*1000, 1),
+        }
+        mylogger.info(f'media stats: {stats}')
+        if self.__container is not None:
+            self.__container.media_stats = stats
+
     @property
     def audio(self) -> MediaStreamTrack:
         """
@@ -228,3 +374,52 @@ class HumanPlayer:
 
     def __log_debug(self, msg: str, *args) -> None:
         mylogger.debug(f"HumanPlayer {msg}", *args)
+
+
+def benchmark_handoff(sessions=20, seconds=5):
+    '''
+    event loop cpu for sessions render threads each handing 1 video + 2 audio frames per 40ms
+    to two tracks on one loop, run_coroutine_threadsafe per frame vs put_frames. python webrtc.py
+    '''
+    async def run(batched):
+        loop = asyncio.get_running_loop()
+        quit_event = threading.Event()
+        tracks = [(FrameQueue() if batched else asyncio.Queue(), FrameQueue() if batched else asyncio.Queue())
+                  for _ in range(sessions)]
+
+        def producer(video, audio):
+            t = time.perf_counter()
+            while not quit_event.is_set():
+                if batched:
+                    put_frames(loop, [(video, [(None, None, None)]), (audio, [(None, None, None)]*2)])
+                else:
+                    asyncio.run_coroutine_threadsafe(video.put((None, None, None)), loop)
+                    for _ in range(2):
+                        asyncio.run_coroutine_threadsafe(audio.put((None, None, None)), loop)
+                t += VIDEO_PTIME
+                time.sleep(max(0, t - time.perf_counter()))
+
+        async def consumer(q):
+            while True:
+                await q.get()
+
+        consumers = [asyncio.ensure_future(consumer(q)) for pair in tracks for q in pair]
+        threads = [threading.Thread(target=producer, args=pair) for pair in tracks]
+        cpu = time.thread_time()
+        for thread in threads:
+            thread.start()
+        await asyncio.sleep(seconds)
+        cpu = time.thread_time() - cpu
+        quit_event.set()
+        for thread in threads:
+            thread.join()
+        for task in consumers:
+            task.cancel()
+        return cpu
+
+    for name, batched in [('run_coroutine_threadsafe', False), ('put_frames', True)]:
+        cpu = asyncio.run(run(batched))
+        print(f'{name:25s} {sessions} sessions: loop cpu {cpu/seconds*100:.1f}% of a core, {cpu/seconds/sessions*1000:.2f}ms/s per session')
+
+if __name__ == '__main__':
+    benchmark_handoff()